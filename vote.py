@@ -25,37 +25,92 @@
 
 # Allows Google API calls
 import gspread
+import httplib2
+import httplib
+import requests
 from oauth2client.service_account import ServiceAccountCredentials
 # Common headers
 import sys
 import random
 import time
+import datetime
+import threading
+# Voter IDs are authenticated with a keyed hash
+import hmac
+import hashlib
 # Enables basic email functionality
 import imaplib
 import smtplib
 import textwrap
 # Headers needed for packing votes into xlsx and attaching to email
 import xlsxwriter
+import csv
+import json
+import gzip
 from os.path import basename
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 # Allows commandline text to be entered without echoing
 import getpass
-# Allows pinging to check internet connection
-import subprocess
+# Allows probing the internet connection
+import socket
 # Allows us to check what OS this script is running on
 import os
+# Per-election state and scheduling of several elections
+import copy
+import heapq
+# Latency histograms of the metrics
+import bisect
+import contextlib
+# Encrypted checkpoints of the election state
+import struct
+import marshal
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+# Vectorized vote tabulation
+import numpy as np
+# Resampled elections are counted on a process pool
+import multiprocessing
 
 # Constant used in program.
 LARGE_POSITIVE_INT = 1e15
+# Rank given to blank (unranked) entries in an IRV rank matrix. Sorts after every real rank
+RANK_BLANK = np.iinfo(np.int16).max
+# How IRV rounds are recounted. "vectorized" rescans the whole rank matrix every round,
+# "incremental" keeps ballots bucketed by top choice and only moves eliminated buckets
+IRV_MODE = "vectorized"
 # The number of columns in the spreadsheet holding survey results.
 # Make global to reduce Google API calls
 NUM_COLS = -1
-# Global string representing the type of vote - referndum or IRV
+# Global string representing the type of vote - referndum, IRV, STV or condorcet
 VOTE_TYPE = ''
-# Global list of unique numbers used in vote validation
-all_voter_ids = []
+# How a condorcet vote picks its winner. "schulze" or "ranked pairs"
+CONDORCET_METHOD = "schulze"
+# Also find the Schulze winner of every IRV position as an independent cross-check
+CONDORCET_CROSS_CHECK_IRV = True
+# Log how close every IRV position was: bounds on the ballots that would have to change
+# to alter its winner or elimination order
+IRV_MARGIN_ANALYSIS = True
+# Number of resampled elections used to estimate how stable each IRV winner is. 0 to skip
+IRV_BOOTSTRAP_SAMPLES = 200
+# Worker processes for the resampled elections. None for one per CPU, 1 to stay in-process
+IRV_BOOTSTRAP_PROCESSES = None
+# Resampled elections per seeded chunk. Fixing the chunk size instead of deriving it from
+# the process count keeps the estimate the same however many processes run it
+IRV_BOOTSTRAP_CHUNK_SAMPLES = 25
+# Worker processes the positions of a ranked vote are counted on. None for one per CPU,
+# 1 to count in-process. Workers are forked after the ballots are loaded, so they read
+# them from memory shared with this process instead of copying them
+TABULATION_PROCESSES = None
+# Ballot patterns compared at once when building a pairwise preference matrix. Bounds
+# the memory used to patterns x candidates x candidates booleans per chunk
+PAIRWISE_CHUNK_SIZE = 4096
+# Number of seats to fill for each position of an STV vote, in header order
+SEATS_PER_POSITION = []
+# Secret key of this election. Every voter ID ends in a MAC of its nonce under this key,
+# so an ID can be validated by recomputing the MAC without any list of issued IDs
+ELECTION_KEY = ''
 # Votes to ignore (invalid ID or repeated ID)
 blacklist = []
 # Global 2D array of worksheet holding all voter responses
@@ -64,27 +119,80 @@ all_data = []
 survey_url = ''
 # Global sting holding the title of the worksheet holding raw voter data
 WORKSHEET_TITLE = ''
-# Global list of all emails invited to this survey
-all_email_addresses = []
-# Cooresponding names belonging to those emails 
-all_first_names = []
-all_full_names = []
+# Eligible voters invited to this survey. See Roster
+roster = None
 # Unique id for all voters that identify this particular excution of this script 
 all_survey_ids = []
-# Array of votes detected in the survey results. Used to make sure no votes are deleted.
-# Encodes votes by concatenating all the data in that row into a string.
-votes_seen_so_far = []
-# Holds all information about this vote and the calculation of results
-all_output = ''
+# Digests of the votes detected in the survey results, by row. Used to make sure no votes
+# are deleted, edited or moved. See RowFingerprints
+vote_fingerprints = None
+# Number of vote manipulation checks run so far
+num_polls = 0
+# Whether a poll found votes deleted, edited or moved. Such an election can't be resumed
+votes_manipulated = False
+# BackgroundJob emailing the voters that the vote was canceled, None unless tampering was
+# detected
+tamper_notice_job = None
+# Votes, turnout and validity counts as of the latest poll. See PollSnapshot
+vote_snapshot = None
+# Whether print_write also prints. Off in tabulation workers, whose output is printed by
+# the parent process in position order
+echo_output = True
+# Counts one position of the vote being tabulated. Set while tabulation workers run
+tabulation_task = None
+# Valid ballots of each position collapsed into {pattern: weight}. A pattern is the
+# tuple of raw cell values in that position's columns
+compressed_ballots = []
 # The account that to send all emails.
 HOST_GMAIL_ACCOUNT = "averyexcomm@gmail.com"
+# Outgoing mail server. To test without sending real mail, run a local debugging server
+# (python -m smtpd -n -c DebuggingServer localhost:1025) and point these at it with
+# SMTP_USE_TLS = False. No login is attempted when the password is None.
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 587
+SMTP_USE_TLS = True
+# Number of SMTP connections delivering emails in parallel
+SMTP_POOL_SIZE = 4
+# Most emails sent per second across all connections
+SMTP_MAX_SENDS_PER_SECOND = 2
+# Attempts per email, each on a fresh connection, before giving up on the vote
+SMTP_MAX_ATTEMPTS = 20
+# Seconds between progress reports while emails are going out
+SMTP_PROGRESS_INTERVAL = 10
 # Param that allows APIs to read from Google docs
 SCOPES = [ "https://docs.google.com/feeds/ https://spreadsheets.google.com/feeds/"]
 # Key to Google spreadsheet that hosts the survey results. 
 # Must explicitly link to your local machine.
 LINKED_SPREADSHEET_KEY = "1Pfzdngzcxt94iFSpPxf88TyMehsUcLS-zf5TovR0Ks8"
+# Key of the private spreadsheet listing every eligible voter. The roster is its first worksheet
+ROSTER_SPREADSHEET_KEY = "1Kodv_Fzz9Oki6q9w14jGddP49XFWD8VnXfFlxyViMVY"
+# Local copy of the roster, reused for as long as the roster worksheet is not edited
+ROSTER_CACHE_FILE = "roster_cache.json"
 # Json file in current directory with oauth2 credentials. Downloaded from Google API console
 SECRETS = "OnlineVoting-e363607f6925.json"
+# Refresh the OAuth2 access token when it is this close to expiring (seconds)
+TOKEN_REFRESH_MARGIN = 300
+# Google Sheets API quota for one user. Requests beyond it come back as HTTP 429
+SHEETS_REQUESTS_PER_MINUTE = 60
+# Number of Sheets requests that may go out back to back before the quota rate applies
+SHEETS_BURST = 10
+# Give up on a Sheets call that has not succeeded within this many seconds. Default 24 hrs.
+# Only quota, server and connection errors are retried
+SHEETS_RETRY_DEADLINE = 86400
+# Upper bounds on the first and on any wait between retries of a failed Sheets call (seconds)
+RETRY_INITIAL_BACKOFF = 2
+RETRY_MAX_BACKOFF = 300
+# The internet connection is probed with a TCP connect to this host and port (a public
+# DNS server). Results are reused for CONNECTIVITY_CACHE_SECONDS
+CONNECTIVITY_PROBE_HOST = "8.8.8.8"
+CONNECTIVITY_PROBE_PORT = 53
+CONNECTIVITY_PROBE_TIMEOUT = 3
+CONNECTIVITY_CACHE_SECONDS = 10
+# Consecutive connection failures of Sheets and SMTP calls that pause all of them
+BREAKER_FAILURE_THRESHOLD = 5
+# First pause once the connection is lost (seconds). Doubles, up to RETRY_MAX_BACKOFF,
+# while the connection stays down
+BREAKER_OPEN_SECONDS = 30
 # Holds the user-specified subject line for emails
 SUBJECT = ''
 # Holds text describing results of election for use in body of email
@@ -97,36 +205,148 @@ TIME_LIMIT_QUORUM = 86400
 # Time to wait in between vote manipulation checks (seconds).
 # Too low could cause Google API error
 CHECKS_INTERVAL = 5
+# Between integrity checks, polls only fetch the rows appended since the last poll, this
+# many rows per request
+DELTA_POLL_WINDOW = 200
+# Every this many polls, download the whole worksheet and re-check every vote seen so far
+INTEGRITY_CHECK_EVERY_N_POLLS = 12
 # The number of digits in each voter ID
 VOTER_ID_LENGTH = 128
+# Trailing digits of a voter ID holding the MAC. A SHA-256 digest takes 78 decimal digits
+VOTER_ID_MAC_LENGTH = 78
 # The number of digits in the survey ID
 SURVEY_ID_LENGTH = 4
+# Maximum number of invalid vote markers written to the spreadsheet in one request
+INVALID_VOTE_BATCH_SIZE = 500
+# Formats the raw vote data is exported and attached in. Any of "xlsx", "csv" and
+# "csv.gz". The compressed csv stays small for very large elections
+RAW_VOTES_FORMATS = ["xlsx"]
+# Widest column allowed by Excel
+MAX_XLSX_COLUMN_WIDTH = 255
+# Append-only log of everything this election prints, one timestamped and leveled record
+# per line, written in OUTPUT_DIR as it happens
+ELECTION_LOG_FILE = "election_log.txt"
+# Report of the count alone, written in OUTPUT_DIR and attached to the results email
+RESULTS_REPORT_FILE = "runoff_results.txt"
+# Levels of the log records, least severe first
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+# Records below this level are neither printed nor logged. The results report gets them all
+LOG_LEVEL = "INFO"
+# Most background jobs (sending the links, clearing the sent folder) running at once,
+# across all elections
+BACKGROUND_WORKERS = 4
+# Local file rewritten after every poll with the provisional tally. '' to disable
+PROVISIONAL_TALLY_FILE = "provisional_tally.txt"
+# Directory the files of this election are written to. '' for the working directory
+OUTPUT_DIR = ''
+# Local file the call counts, latencies, bytes, retries and sleeps of this process are
+# written to every METRICS_WRITE_INTERVAL seconds. '' to disable
+METRICS_FILE = "metrics.json"
+# "json", or "prometheus" for the Prometheus text format
+METRICS_FORMAT = "json"
+METRICS_WRITE_INTERVAL = 60
+# Upper bounds of the latency histogram buckets (seconds)
+METRICS_LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+# Encrypted log of the election state, written in OUTPUT_DIR so an interrupted election
+# can be resumed. '' to disable
+CHECKPOINT_FILE = "election.checkpoint"
+# PBKDF2 iterations turning the checkpoint passphrase into an encryption key
+CHECKPOINT_KDF_ITERATIONS = 100000
+# Passphrase the checkpoints are encrypted under. Entered when the script starts
+checkpoint_passphrase = None
 
-# Ensure the local machine is connected to the internet. Exit if no internet.
+# Check that the local machine is connected to the internet. Warns if it is not
 def verify_internet_access():
-	success = True
-	host = "8.8.8.8" # Google
-	#Windows OS
-	if(os.name == "nt"):
-		output = subprocess.Popen(["ping.exe",host],stdout = subprocess.PIPE).communicate()[0]
-		if("0% loss" not in output):
-			success = False
-	# UNIX
-	else:
-		output = subprocess.Popen(['ping', '-c 1 -W 1 ', host], stdout=subprocess.PIPE).communicate()[0]
-		if("0% packet loss" not in output):
-			success = False
-	if(success == False):
-		print output
-		print_write(time.ctime() + " UNABLE TO ACCESS INTERNET")
-		#sys.exit(-1)
+	if(not connection_breaker.probe()):
+		print_write(time.ctime() + " UNABLE TO ACCESS INTERNET", "WARNING")
 		
-# Perform a normal print call but also write output to global string "all_output"
-# which will be emailed out at the end of the survey
-def print_write(in_string):
-	global all_output
-	print in_string
-	all_output += in_string + '\n'
+# Path of "file_name" inside OUTPUT_DIR. Creates the directory if needed
+def output_path(file_name):
+	if(OUTPUT_DIR != '' and not os.path.isdir(OUTPUT_DIR)):
+		os.makedirs(OUTPUT_DIR)
+	return os.path.join(OUTPUT_DIR, file_name)
+
+# Move "temp_file_name" over "file_name". On Windows os.rename does not replace an
+# existing file
+def replace_file(temp_file_name, file_name):
+	if(os.name == "nt" and os.path.exists(file_name)):
+		os.remove(file_name)
+	os.rename(temp_file_name, file_name)
+
+# Serializes writes to the election logs. Email workers log from their own threads
+log_lock = threading.Lock()
+
+# Streams what an election prints to ELECTION_LOG_FILE, one record per message. Records
+# written inside "with log.report():" also go, without timestamp or level, to
+# RESULTS_REPORT_FILE, so the count is sent out apart from the operational messages. The
+# files are opened in OUTPUT_DIR on first use and the log is appended to, so a resumed
+# election carries on with the same log. LOG_LEVEL only filters the log: the report gets
+# every record, so a quiet log still sends the whole count. A "capture" log keeps every
+# (level, message) record in memory instead, for tabulation workers to hand back to the
+# parent process.
+class ElectionLog(object):
+	def __init__(self, capture=False):
+		self.captured = [] if capture else None
+		self.log_file = None
+		self.report_file = None
+		self.num_report_records = 0
+
+	def write(self, level, message):
+		if(isinstance(message, unicode)):
+			message = message.encode('utf-8')
+		# Tabulation workers may be forked while another thread holds log_lock
+		if(self.captured is not None):
+			self.captured.append((level, message))
+			return
+		with log_lock:
+			if(is_logged(level)):
+				if(self.log_file is None):
+					self.log_file = open(output_path(ELECTION_LOG_FILE), "a")
+				self.log_file.write(time.strftime("%Y-%m-%d %H:%M:%S") + " " + level + " " + message + "\n")
+				self.log_file.flush()
+			if(self.report_file is not None):
+				self.report_file.write(message + "\n")
+				self.report_file.flush()
+				self.num_report_records += 1
+
+	# Start RESULTS_REPORT_FILE afresh and copy every record written in the enclosed block to it
+	@contextlib.contextmanager
+	def report(self):
+		if(self.captured is None):
+			self.report_file = open(output_path(RESULTS_REPORT_FILE), "w")
+			self.num_report_records = 0
+		try:
+			yield
+		finally:
+			if(self.report_file is not None):
+				self.report_file.close()
+				self.report_file = None
+
+	def close(self):
+		if(self.log_file is not None):
+			self.log_file.close()
+			self.log_file = None
+
+# Log of the election being run
+election_log = ElectionLog()
+
+# Per-thread log override. Background jobs, and the email workers they start, keep
+# logging to the election they were started from while other elections are entered
+log_context = threading.local()
+
+# Log the current thread writes to
+def current_log():
+	return getattr(log_context, "log", None) or election_log
+
+# Whether records of "level" are printed and logged
+def is_logged(level):
+	return LOG_LEVELS.index(level) >= LOG_LEVELS.index(LOG_LEVEL)
+
+# Print a message and write it to the election log with "level", one of LOG_LEVELS
+def print_write(in_string, level="INFO"):
+	if(echo_output and is_logged(level)):
+		print in_string
+	current_log().write(level, in_string)
 		
 # Generate time-seeded random number with n digits. Used to generate voter IDs and pins
 def random_with_N_digits(n):
@@ -136,136 +356,512 @@ def random_with_N_digits(n):
 	range_end = (10**n)-1
 	return random.randint(range_start, range_end)
 
-# Use credentials to return an authenticated worksheet object with voter data
-def renewed_worksheet():
+# Counters and latency histograms of the hot paths of this process: Sheets calls, emails,
+# IMAP operations, polls and tabulation. Every series is a metric name and a label, such
+# as the type of Sheets call. Safe to share between threads.
+class Metrics(object):
+	def __init__(self, buckets):
+		self.buckets = sorted(buckets)
+		self.counters = {}
+		# (name, label) -> [counts per bucket with +Inf last, sum of seconds, count]
+		self.histograms = {}
+		self.last_write = time.time()
+		self.lock = threading.Lock()
+
+	# Add "amount" to counter "name"
+	def count(self, name, label='', amount=1):
+		with self.lock:
+			self.counters[(name, label)] = self.counters.get((name, label), 0) + amount
+
+	# Record a duration of "seconds" in histogram "name"
+	def observe(self, name, label, seconds):
+		with self.lock:
+			histogram = self.histograms.get((name, label))
+			if(histogram is None):
+				histogram = self.histograms[(name, label)] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+			histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+			histogram[1] += seconds
+			histogram[2] += 1
+
+	# Record how long the enclosed block took in histogram "name"
+	@contextlib.contextmanager
+	def timed(self, name, label=''):
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.observe(name, label, time.time() - start)
+
+	# Values of counter "name" by label
+	def series(self, name):
+		with self.lock:
+			return dict((label, value) for (counter, label), value in self.counters.items() if counter == name)
+
+	# Counters as {name: {label: value}} and histograms as {name: {label: {"buckets":
+	# [[upper bound, cumulative count], ...], "sum": seconds, "count": count}}}
+	def as_dict(self):
+		counters = {}
+		histograms = {}
+		with self.lock:
+			for (name, label), value in self.counters.items():
+				counters.setdefault(name, {})[label] = value
+			for (name, label), (bucket_counts, seconds, num) in self.histograms.items():
+				cumulative = [sum(bucket_counts[:i + 1]) for i in range(len(bucket_counts))]
+				histograms.setdefault(name, {})[label] = {"buckets": map(list, zip(self.buckets + ["+Inf"], cumulative)), \
+				"sum": seconds, "count": num}
+		return {"time": time.time(), "counters": counters, "histograms": histograms}
+
+	# The metrics in the Prometheus text format, with every name prefixed by "vote_"
+	def as_prometheus(self):
+		def series_name(name, label, extra=''):
+			labels = []
+			if(label != ''):
+				label = label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+				labels.append('type="' + label + '"')
+			if(extra != ''):
+				labels.append(extra)
+			return "vote_" + name + ("{" + ",".join(labels) + "}" if labels != [] else "")
+		metrics_dict = self.as_dict()
+		lines = []
+		for name, values in sorted(metrics_dict["counters"].items()):
+			lines.append("# TYPE vote_" + name + " counter")
+			for label, value in sorted(values.items()):
+				lines.append(series_name(name, label) + " " + repr(float(value)))
+		for name, values in sorted(metrics_dict["histograms"].items()):
+			lines.append("# TYPE vote_" + name + " histogram")
+			for label, histogram in sorted(values.items()):
+				for upper_bound, num in histogram["buckets"]:
+					lines.append(series_name(name + "_bucket", label, 'le="' + str(upper_bound) + '"') + " " + str(num))
+				lines.append(series_name(name + "_sum", label) + " " + repr(histogram["sum"]))
+				lines.append(series_name(name + "_count", label) + " " + str(histogram["count"]))
+		return "\n".join(lines) + "\n"
+
+	# Atomically replace "file_name" with the metrics in "file_format"
+	def write(self, file_name, file_format):
+		if(file_format == "prometheus"):
+			text = self.as_prometheus()
+		else:
+			text = json.dumps(self.as_dict(), sort_keys=True)
+		temp_file_name = file_name + ".tmp"
+		with open(temp_file_name, "w") as file:
+			file.write(text)
+		replace_file(temp_file_name, file_name)
+		self.last_write = time.time()
+
+# Shared by everything this process does
+metrics = Metrics(METRICS_LATENCY_BUCKETS)
+
+# Write the metrics to METRICS_FILE once METRICS_WRITE_INTERVAL seconds have passed
+# since they were last written, or right away with "force"
+def write_metrics(force=False):
+	if(METRICS_FILE == ''):
+		return
+	if(force or time.time() - metrics.last_write >= METRICS_WRITE_INTERVAL):
+		metrics.write(METRICS_FILE, METRICS_FORMAT)
+
+# Token bucket rate limiter. Holds at most "capacity" tokens and regains "rate" tokens
+# per second. Safe to share between threads. Time spent waiting for tokens is counted
+# in the metrics under "name".
+class TokenBucket(object):
+	def __init__(self, rate, capacity, name=''):
+		self.rate = float(rate)
+		self.capacity = float(capacity)
+		self.tokens = float(capacity)
+		self.last_refill = time.time()
+		self.lock = threading.Lock()
+		self.name = name
+
+	# Block until "cost" tokens are available and take them
+	def acquire(self, cost=1):
+		while(True):
+			with self.lock:
+				now = time.time()
+				self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+				self.last_refill = now
+				if(self.tokens >= cost):
+					self.tokens -= cost
+					return
+				wait = (cost - self.tokens) / self.rate
+			time.sleep(wait)
+			metrics.count("sleep_seconds_total", self.name, wait)
+
+# Circuit breaker shared by every call that needs the internet connection. It opens after
+# "failure_threshold" consecutive connection failures, or after one if the connection
+# probe fails too. While it is open, callers wait together for the same reopening time
+# instead of each backing off on its own. The connection is then probed once: if it is
+# still down the breaker stays open for twice as long, otherwise calls go through again
+# and the first success closes it. Losing and regaining the connection is logged once.
+class CircuitBreaker(object):
+	def __init__(self, failure_threshold, open_seconds):
+		self.failure_threshold = failure_threshold
+		self.open_seconds = open_seconds
+		self.failures = 0
+		# End of the current pause, None while calls may go through
+		self.open_until = None
+		self.pause = open_seconds
+		# Whether the connection was lost and has not been used successfully since
+		self.tripped = False
+		self.last_probe_time = None
+		self.last_probe_result = True
+		self.lock = threading.Lock()
+		self.probe_lock = threading.Lock()
+
+	# Whether CONNECTIVITY_PROBE_HOST accepts a TCP connection. A result younger than
+	# CONNECTIVITY_CACHE_SECONDS is reused
+	def probe(self):
+		with self.probe_lock:
+			if(self.last_probe_time is not None and time.time() - self.last_probe_time < CONNECTIVITY_CACHE_SECONDS):
+				return self.last_probe_result
+			try:
+				socket.create_connection((CONNECTIVITY_PROBE_HOST, CONNECTIVITY_PROBE_PORT), \
+				CONNECTIVITY_PROBE_TIMEOUT).close()
+				self.last_probe_result = True
+			except socket.error:
+				self.last_probe_result = False
+			self.last_probe_time = time.time()
+			metrics.count("connectivity_probes_total", "Online" if self.last_probe_result else "Offline")
+			return self.last_probe_result
+
+	def is_open(self):
+		with self.lock:
+			return self.open_until is not None
+
+	# Block until calls may go through, or until "deadline" if one is given
+	def wait(self, deadline=None):
+		while(True):
+			with self.lock:
+				open_until = self.open_until
+			if(open_until is None or (deadline is not None and time.time() >= deadline)):
+				return
+			wait = open_until - time.time()
+			if(deadline is not None):
+				wait = min(wait, deadline - time.time())
+			if(wait > 0):
+				time.sleep(wait)
+				metrics.count("sleep_seconds_total", "Circuit breaker", wait)
+				continue
+			online = self.probe()
+			with self.lock:
+				# Only the first caller to get here decides
+				if(self.open_until != open_until):
+					continue
+				if(online):
+					self.open_until = None
+				else:
+					self.pause = min(self.pause * 2, RETRY_MAX_BACKOFF)
+					self.open_until = time.time() + self.pause
+
+	# A call went through, so the connection is up
+	def record_success(self):
+		with self.lock:
+			self.failures = 0
+			self.pause = self.open_seconds
+			restored = self.tripped
+			self.tripped = False
+		if(restored):
+			print_write(time.ctime() + " Internet connection restored", "WARNING")
+
+	# A call failed without reaching its server
+	def record_failure(self):
+		with self.lock:
+			self.failures += 1
+			if(self.open_until is not None):
+				return
+			below_threshold = self.failures < self.failure_threshold
+			tripped = self.tripped
+		# Right after a pause a single failure is enough. Otherwise the probe breaks the tie
+		if(not tripped and below_threshold and self.probe()):
+			return
+		with self.lock:
+			if(self.open_until is not None):
+				return
+			self.open_until = time.time() + self.pause
+			newly_tripped = not self.tripped
+			self.tripped = True
+		if(newly_tripped):
+			metrics.count("circuit_breaker_trips_total")
+			print_write(time.ctime() + " Internet connection lost. Sheets and email calls paused", "WARNING")
+
+# Shared by the Sheets and SMTP calls
+connection_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_OPEN_SECONDS)
+
+# Every request to the Sheets API goes through this limiter
+sheets_rate_limiter = TokenBucket(SHEETS_REQUESTS_PER_MINUTE / 60.0, SHEETS_BURST, "Sheets rate limit")
+
+# Source of voter ID nonces and election keys
+secure_random = random.SystemRandom()
+
+# Start a new election with a fresh secret key
+def generate_election_key():
+	global ELECTION_KEY
+	ELECTION_KEY = os.urandom(32)
+
+# MAC of a voter ID nonce under "key", ELECTION_KEY by default, as VOTER_ID_MAC_LENGTH
+# decimal digits
+def voter_id_mac(nonce, key=None):
+	digest = hmac.new(key or ELECTION_KEY, nonce, hashlib.sha256).hexdigest()
+	return str(int(digest, 16)).zfill(VOTER_ID_MAC_LENGTH)
+
+# Issue a voter ID of VOTER_ID_LENGTH digits: a random nonce followed by its MAC under
+# "key", ELECTION_KEY by default
+def new_voter_id(key=None):
+	nonce_length = VOTER_ID_LENGTH - VOTER_ID_MAC_LENGTH
+	nonce = str(secure_random.randint(10**(nonce_length - 1), 10**nonce_length - 1))
+	return nonce + voter_id_mac(nonce, key)
+
+# Check that a voter ID was issued for this election by recomputing its MAC.
+# Constant time per ID no matter how many voters there are.
+def is_valid_voter_id(voter_id):
+	try:
+		voter_id = str(voter_id)
+	except UnicodeError:
+		return False
+	if(len(voter_id) != VOTER_ID_LENGTH or not voter_id.isdigit()):
+		return False
+	nonce = voter_id[:-VOTER_ID_MAC_LENGTH]
+	return hmac.compare_digest(voter_id_mac(nonce), voter_id[-VOTER_ID_MAC_LENGTH:])
+
+# Long-lived Google Sheets session. Owns the authorized client along with the opened
+# spreadsheet and worksheet handles so that polling does not re-authenticate on every
+# call. The access token is refreshed shortly before it expires and a worksheet is only
+# re-opened after a call on it has failed.
+class SheetsSession(object):
+	def __init__(self):
+		self.credentials = None
+		self.client = None
+		# Cached handles keyed by spreadsheet key and by (spreadsheet key, worksheet)
+		self.spreadsheets = {}
+		self.worksheets = {}
+		# (spreadsheet key, worksheet) every handle handed out was opened from
+		self.origins = {}
+
+	# Build a fresh client from the json credentials, dropping every cached handle
+	def authorize(self):
+		metrics.count("sheets_authorizations_total")
+		with metrics.timed("sheets_auth_seconds", "Authorization"):
+			self.credentials = ServiceAccountCredentials.from_json_keyfile_name(SECRETS, scopes=SCOPES)
+			self.client = gspread.authorize(self.credentials)
+		self.spreadsheets = {}
+		self.worksheets = {}
+
+	# Refresh the access token if it expires within TOKEN_REFRESH_MARGIN seconds
+	def refresh_token_if_needed(self):
+		if(self.client is None):
+			self.authorize()
+			return
+		expiry = self.credentials.token_expiry
+		margin = datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN)
+		if(expiry is None or expiry - datetime.datetime.utcnow() < margin):
+			metrics.count("sheets_token_refreshes_total")
+			with metrics.timed("sheets_auth_seconds", "Token refresh"):
+				self.credentials.refresh(httplib2.Http())
+				self.client.login()
+
+	# Return the worksheet "sheet" (a title or an index) of spreadsheet "key". With "fresh",
+	# the worksheets of the spreadsheet are listed again so that the size and revision of
+	# the handle are current
+	def worksheet(self, key, sheet, fresh=False):
+		self.refresh_token_if_needed()
+		if(fresh and (key, sheet) in self.worksheets):
+			self.origins.pop(id(self.worksheets.pop((key, sheet))), None)
+		if(fresh and key in self.spreadsheets):
+			# gspread hands out the worksheets it listed when the spreadsheet was opened
+			spreadsheet = self.spreadsheets[key]
+			if(hasattr(spreadsheet, '_fetch_sheets')):
+				sheets_rate_limiter.acquire()
+				spreadsheet._fetch_sheets()
+			else:
+				del self.spreadsheets[key]
+		if((key, sheet) not in self.worksheets):
+			if(key not in self.spreadsheets):
+				sheets_rate_limiter.acquire()
+				self.spreadsheets[key] = self.client.open_by_key(key)
+			sheets_rate_limiter.acquire()
+			if(isinstance(sheet, int)):
+				handle = self.spreadsheets[key].get_worksheet(sheet)
+			else:
+				handle = self.spreadsheets[key].worksheet(sheet)
+			self.worksheets[(key, sheet)] = handle
+			self.origins[id(handle)] = (handle, key, sheet)
+		return self.worksheets[(key, sheet)]
+
+	# Fetch a worksheet again from its cached spreadsheet to pick up its current size
+	def refresh(self, worksheet):
+		if(id(worksheet) not in self.origins):
+			return worksheet
+		handle, key, sheet = self.origins[id(worksheet)]
+		return self.worksheet(key, sheet, fresh=True)
+
+	# Re-authorize and open again the worksheet behind a handle whose last call failed
+	def reopen(self, worksheet):
+		key, sheet = LINKED_SPREADSHEET_KEY, WORKSHEET_TITLE
+		if(id(worksheet) in self.origins):
+			handle, key, sheet = self.origins.pop(id(worksheet))
+		self.authorize()
+		return self.worksheet(key, sheet)
+
+# Shared by every Google Sheets call in this process
+sheets_session = SheetsSession()
+
+# Characters of cell text in the result of a Sheets call: a value, a cell or a list of
+# either or of rows. gspread does not expose the size of its responses, so this stands in
+# for the bytes received
+def sheets_payload_size(result):
+	if(isinstance(result, basestring)):
+		return len(result)
+	if(isinstance(result, list)):
+		return sum(sheets_payload_size(item) for item in result)
+	value = getattr(result, 'value', None)
+	return len(value) if isinstance(value, basestring) else 0
+
+# HTTP status code behind a failed gspread call, or None for errors that never got a
+# response (connection resets, timeouts, DNS failures...)
+def http_status_of(error):
+	response = getattr(error, 'response', None)
+	if(response is not None and hasattr(response, 'status_code')):
+		return response.status_code
+	# Older gspread raises RequestError(status_code, message)
+	if(len(error.args) > 0 and isinstance(error.args[0], int)):
+		return error.args[0]
+	return None
+
+# Failures of a Sheets call that never got a response from Google
+SHEETS_CONNECTION_ERRORS = (socket.error, httplib.HTTPException, httplib2.HttpLib2Error, \
+requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)
+
+# Run "request(worksheet)" against the Sheets API and return its result. Every attempt
+# takes "cost" tokens from the shared rate limiter. Quota errors (429), server errors
+# (5xx) and failures that never reached Google are retried with exponential backoff and
+# full jitter until SHEETS_RETRY_DEADLINE. Expired credentials (401) are renewed right
+# away, once, and the worksheet is re-opened after any retried failure other than a quota
+# error. Any other error, such as a missing worksheet, would fail the same way again, so
+# it is raised at once. Failures that never reached Google count towards the shared
+# connection_breaker, which takes over the waiting while it is open. Each attempt is timed in the metrics under
+# "call_type".
+def call_sheets_api(call_type, request, worksheet=None, cost=1):
 	if(WORKSHEET_TITLE == ''):
-		print_write("FATAL: Worksheet title does not exit")
+		print_write("FATAL: Worksheet title does not exit", "ERROR")
 		sys.exit(-1)
+	deadline = time.time() + SHEETS_RETRY_DEADLINE
+	backoff = RETRY_INITIAL_BACKOFF
 	times_attempted = 0
-	max_num_attempts = 86400
 	time_of_initial_attempt = time.ctime()
-	while(times_attempted < max_num_attempts):
+	reopen = False
+	while(True):
 		try:
 			times_attempted = times_attempted + 1
-			credentials = ServiceAccountCredentials.from_json_keyfile_name(SECRETS, scopes=SCOPES)
-			gc = gspread.authorize(credentials)
-			sh = gc.open_by_key(LINKED_SPREADSHEET_KEY)
-			authenticated_worksheet = sh.worksheet(WORKSHEET_TITLE)
-			time.sleep(2) # Ensure we don't call Google APIs too rapidly
+			connection_breaker.wait(deadline)
+			if(reopen):
+				if(worksheet is None):
+					sheets_session.authorize()
+				else:
+					worksheet = sheets_session.reopen(worksheet)
+				reopen = False
+			sheets_rate_limiter.acquire(cost)
+			with metrics.timed("sheets_call_seconds", call_type):
+				result = request(worksheet)
+			connection_breaker.record_success()
 			break
-		except Exception as e: #Maybe we are using APIs too much. Try again after waiting
-			print e
-			verify_internet_access()
-			time.sleep(10)
-	if(times_attempted == max_num_attempts):
-		print "FATAL: Unable to recover"
-		sys.exit(-1)
-	else:
-		if(times_attempted > 1):
-			print_write("[" + time_of_initial_attempt + ", " + time.ctime() + "]" + " Worksheet successfully renewed after " + str(times_attempted) + " tries")
-		return authenticated_worksheet
+		except Exception as e:
+			connection_lost = isinstance(e, SHEETS_CONNECTION_ERRORS)
+			status = None if connection_lost else http_status_of(e)
+			if(not connection_lost and status != 429 and not (status == 401 and times_attempted == 1) \
+			and (status is None or status < 500)):
+				print_write(call_type + " failed: " + repr(e), "ERROR")
+				raise
+			print_write(call_type + " failed: " + repr(e), "WARNING")
+			metrics.count("sheets_retries_total", call_type)
+			if(time.time() >= deadline):
+				print_write("FATAL: Unable to recover", "ERROR")
+				sys.exit(-1)
+			reopen = (status != 429)
+			if(connection_lost):
+				connection_breaker.record_failure()
+				if(connection_breaker.is_open()):
+					continue
+			else:
+				connection_breaker.record_success()
+			# A stale token is fixed by renewing it, no need to wait
+			if(status == 401 and times_attempted == 1):
+				continue
+			wait = min(random.uniform(0, backoff), max(0, deadline - time.time()))
+			time.sleep(wait)
+			metrics.count("sleep_seconds_total", "Sheets retry backoff", wait)
+			metrics.count("sheets_retry_wait_seconds_total", call_type, wait)
+			backoff = min(backoff * 2, RETRY_MAX_BACKOFF)
+	if(times_attempted > 1):
+		print_write("[" + time_of_initial_attempt + ", " + time.ctime() + "] " + call_type + " successfully completed after " + str(times_attempted) + " tries", "WARNING")
+	metrics.count("sheets_calls_total", call_type)
+	metrics.count("sheets_bytes_received_total", call_type, sheets_payload_size(result))
+	return result
+
+# Print how many retries each type of Sheets call needed and how long they waited
+def print_sheets_retry_summary():
+	retries_by_type = metrics.series("sheets_retries_total")
+	waits_by_type = metrics.series("sheets_retry_wait_seconds_total")
+	for call_type in sorted(retries_by_type):
+		retries, seconds_waited = retries_by_type[call_type], waits_by_type.get(call_type, 0)
+		print_write(call_type + ": " + str(retries) + " retries, " + str(int(seconds_waited)) + " seconds waited")
+
+# Return an authenticated worksheet object with voter data from the shared session
+def renewed_worksheet():
+	return call_sheets_api("Worksheet renewal", \
+	lambda worksheet: sheets_session.worksheet(LINKED_SPREADSHEET_KEY, WORKSHEET_TITLE), cost=0)
 
 # Try to read a column from a recently authenticated voter data worksheet
 def grab_col_safe(authenticated_worksheet, col_num):
-	if(WORKSHEET_TITLE == ''):
-		print_write("FATAL: Worksheet title does not exit")
-		sys.exit(-1)
-	times_attempted = 0
-	max_num_attempts = 86400
-	time_of_initial_attempt = time.ctime()
-	while(times_attempted < max_num_attempts):
-		try:
-			times_attempted = times_attempted + 1
-			requested_col = authenticated_worksheet.col_values(col_num)
-			time.sleep(2) # Ensure we don't call Google APIs too rapidly
-			break
-		except: #Maybe we are using APIs too much. Try again after waiting
-			verify_internet_access()
-			time.sleep(10)
-			authenticated_worksheet = renewed_worksheet()
-	if(times_attempted == max_num_attempts):
-		print "FATAL: Unable to recover"
-		sys.exit(-1)
-	else:
-		if(times_attempted > 1):
-			print_write("[" + time_of_initial_attempt + ", " + time.ctime() + "]" + " Column successfully aquired after " + str(times_attempted) + " tries")
-		return requested_col
+	return call_sheets_api("Column read", \
+	lambda worksheet: worksheet.col_values(col_num), authenticated_worksheet)
 	
 # Try to read a row from a recently authenticated voter data worksheet
 def grab_row_safe(authenticated_worksheet, row_num):
-	if(WORKSHEET_TITLE == ''):
-		print_write("FATAL: Worksheet title does not exit")
-		sys.exit(-1)
-	times_attempted = 0
-	max_num_attempts = 86400
-	time_of_initial_attempt = time.ctime()
-	while(times_attempted < max_num_attempts):
-		try:
-			times_attempted = times_attempted + 1
-			requested_row = authenticated_worksheet.row_values(row_num)
-			time.sleep(2) # Ensure we don't call Google APIs too rapidly
-			break
-		except: #Maybe we are using APIs too much. Try again after waiting
-			verify_internet_access()
-			time.sleep(10)
-			authenticated_worksheet = renewed_worksheet()
-	if(times_attempted == max_num_attempts):
-		print "FATAL: Unable to recover"
-		sys.exit(-1)
-	else:
-		if(times_attempted > 1):
-			print_write("[" + time_of_initial_attempt + ", " + time.ctime() + "]" + " Row successfully aquired after " + str(times_attempted) + " tries")
-		return requested_row
+	return call_sheets_api("Row read", \
+	lambda worksheet: worksheet.row_values(row_num), authenticated_worksheet)
 	
 # Try to read all data from a recently authenticated worksheet with voter data
 def grab_all_data_safe(authenticated_worksheet):
-	if(WORKSHEET_TITLE == ''):
-		print_write("FATAL: Worksheet title does not exit")
-		sys.exit(-1)
-	times_attempted = 0
-	max_num_attempts = 86400
-	time_of_initial_attempt = time.ctime()
-	while(times_attempted < max_num_attempts):
-		try:
-			times_attempted = times_attempted + 1
-			requested_data = authenticated_worksheet.get_all_values()
-			time.sleep(2) # Ensure we don't call Google APIs too rapidly
-			break
-		except: #Maybe we are using APIs too much. Try again after waiting
-			verify_internet_access()
-			time.sleep(10)
-			authenticated_worksheet = renewed_worksheet()
-	if(times_attempted == max_num_attempts):
-		print "FATAL: Unable to recover"
-		sys.exit(-1)
-	else:
-		if(times_attempted > 1):
-			print_write("[" + time_of_initial_attempt + ", " + time.ctime() + "]" + " All data successfully acquired after " + str(times_attempted) + " tries")
-		return requested_data
+	return call_sheets_api("All data read", \
+	lambda worksheet: worksheet.get_all_values(), authenticated_worksheet)
 
-# Try to update an entry in a worksheet hosting the voter data
-def update_worksheet_cell_safe(worksheet, row, col, new_val):
-	if(WORKSHEET_TITLE == ''):
-		print_write("FATAL: Worksheet title does not exit")
-		sys.exit(-1)
-	times_attempted = 0
-	max_num_attempts = 86400
-	time_of_initial_attempt = time.ctime()
-	while(times_attempted < max_num_attempts):
-		try:
-			times_attempted = times_attempted + 1
-			worksheet.update_cell(row, col, new_val)
-			time.sleep(2) # Ensure we don't call Google APIs too rapidly
-			break
-		except: #Maybe we are using APIs too much. Try again in 1 minute
-			verify_internet_access()
-			time.sleep(10)
-			worksheet = renewed_worksheet()
-	if(times_attempted == max_num_attempts):
-		print "FATAL: Unable to recover"
+# Read the votes from spreadsheet row "first_row" on, stopping at the first row with a
+# blank timestamp. Reads DELTA_POLL_WINDOW rows per request so a poll only transfers the
+# rows appended since the last one.
+def grab_rows_from_safe(worksheet, first_row):
+	if(NUM_COLS == -1):
+		print_write("FATAL: number of spreadsheet columns not specified", "ERROR")
 		sys.exit(-1)
-	elif(times_attempted > 1):
-		print_write("[" + time_of_initial_attempt + ", " + time.ctime() + "]" + " Cell successfully updated after " + str(times_attempted) + " tries")
+	rows = []
+	while(True):
+		# Forms grow the worksheet as responses arrive. Refresh its size before giving up
+		if(first_row > worksheet.row_count):
+			worksheet = call_sheets_api("Worksheet refresh", sheets_session.refresh, worksheet, cost=0)
+			if(first_row > worksheet.row_count):
+				return rows
+		last_row = min(first_row + DELTA_POLL_WINDOW - 1, worksheet.row_count)
+		cells = call_sheets_api("Range read", \
+		lambda worksheet: worksheet.range(first_row, 1, last_row, NUM_COLS), worksheet)
+		window = [[''] * NUM_COLS for i in range(last_row - first_row + 1)]
+		for cell in cells:
+			window[cell.row - first_row][cell.col - 1] = cell.value
+		for row in window:
+			if(row[0] == ''):
+				return rows
+			rows.append(row)
+		first_row = last_row + 1
+
+# Try to overwrite several cells of one column in a worksheet hosting the voter data.
+# "new_vals" maps 1-indexed row numbers to values. All of them go out in a single
+# range read and a single batch update.
+def update_column_cells_safe(worksheet, col, new_vals):
+	def update(worksheet):
+		cells = worksheet.range(min(new_vals), col, max(new_vals), col)
+		changed_cells = []
+		for cell in cells:
+			if(cell.row in new_vals):
+				cell.value = new_vals[cell.row]
+				changed_cells.append(cell)
+		worksheet.update_cells(changed_cells)
+	call_sheets_api("Cell update", update, worksheet, cost=2)
 
 # Return the first row of the specified worksheet, this is the header info.
 # Need to reomve blank entries since Google spreadsheets pad blanks.
@@ -325,7 +921,7 @@ def get_num_columns():
 # Returns the number of responses in the survey so far
 def get_num_responses():
 	if(WORKSHEET_TITLE == ''):
-		print_write("FATAL: worksheet title not specified")
+		print_write("FATAL: worksheet title not specified", "ERROR")
 		sys.exit(-1)
 		
 	worksheet = renewed_worksheet()
@@ -338,7 +934,7 @@ def get_num_responses():
 # Prevents an extra API call
 def get_num_responses_on_recently_renewed_worksheet(renewed_worksheet):
 	if(WORKSHEET_TITLE == ''):
-		print_write("FATAL: worksheet title not specified")
+		print_write("FATAL: worksheet title not specified", "ERROR")
 		sys.exit(-1)
 	try:
 		first_col = get_first_col_cleaned(renewed_worksheet)
@@ -350,311 +946,549 @@ def get_num_responses_on_recently_renewed_worksheet(renewed_worksheet):
 		return get_num_responses
 
 
-# Returns the number of valid responses in the survey so far
-def get_num_valid_responses():
-	if(WORKSHEET_TITLE == ''):
-		print_write("FATAL: worksheet title not specified")
-		sys.exit(-1)
-	elif(NUM_COLS == -1):
-		print_write("FATAL: number of spreadsheet columns not specified")
-		sys.exit(-1)
-	# Grab worksheet linked to the current survey
-	worksheet = renewed_worksheet()
-	num_responses = get_num_responses_on_recently_renewed_worksheet(worksheet)
+# Reason a ballot's voter ID makes it invalid ("EMPTY", "UNAUTHORIZED" or "REPEATED"),
+# or None for a valid ballot. Valid IDs are recorded in "encountered_IDs" as they are seen
+def classify_voter_id(voter_id, encountered_IDs):
+	if voter_id == '':
+		return "EMPTY"
+	elif not is_valid_voter_id(voter_id):
+		return "UNAUTHORIZED"
+	elif voter_id in encountered_IDs:
+		return "REPEATED"
+	encountered_IDs[voter_id] = True
+	return None
 
-	encountered_IDs = {}
-	last_col = grab_col_safe(worksheet, NUM_COLS)[1:num_responses + 1]
-	num_invalid = 0
-	for i in range(num_responses):
-		if last_col[i] == '':
-			num_invalid += 1
-		elif last_col[i] not in all_voter_ids:
-			num_invalid += 1
-		elif last_col[i] in encountered_IDs:
-			num_invalid += 1
-		else:
-			encountered_IDs[last_col[i]] = True
-			
-	return num_responses - num_invalid
-		
-# Called if an email could not be sent. Re-try the email 
-def email_recovery(server, FROM, TO, message, recipient):
-	# Perhaps it was a network error? Wait and try again
-	times_attempted = 1
-	max_attempts = 20
-	while(times_attempted < max_attempts):
-		print "Previous email failed. Retying email to " + recipient
-		try:
-			time.sleep(10)
-			server.sendmail(FROM, TO, message)
-			break
-		except:
-			times_attempted = times_attempted + 1
-	if(times_attempted == max_attempts):
-			print_write("FATAL: unable to send email to " + recipient)
-			server.quit()
-			sys.exit(-1)
-	else:
-		print "Email successsfully sent to " + recipient
-			
-# If a voter ID is invalid, overwrite it with an error message and blacklist the vote
-def identify_invalid_votes(num_responses):
+# If a voter ID is invalid, overwrite it with an error message and blacklist the vote.
+# Validation runs over the in-memory "all_data" snapshot and only marks it: the markers
+# are written back to the worksheet by write_invalid_vote_marks(). Returns the (vote
+# index, marker) pairs; with dry_run set nothing is blacklisted or marked.
+def identify_invalid_votes(num_responses, dry_run=False):
 	global all_data
 	if(WORKSHEET_TITLE == ''):
-		print_write("FATAL: worksheet title not specified")
+		print_write("FATAL: worksheet title not specified", "ERROR")
 		sys.exit(-1)
 	elif(NUM_COLS == -1):
-		print_write("FATAL: number of spreadsheet columns not specified")
+		print_write("FATAL: number of spreadsheet columns not specified", "ERROR")
 		sys.exit(-1)
 	elif(all_data == []):
-		print_write("FATAL: voter data not loaded into global variable al_data")
+		print_write("FATAL: voter data not loaded into global variable al_data", "ERROR")
 		sys.exit(-1)
 		
-	# Grab worksheet linked to the current survey
-	worksheet = renewed_worksheet()
 	encountered_IDs = {}
-	last_col = grab_col_safe(worksheet, NUM_COLS)[1:num_responses + 1]
-	# + 2 to skip first row and due to spreadsheets being 1 indexed
+	# +1 to skip the header row
+	last_col = [row[NUM_COLS - 1] for row in all_data[1:num_responses + 1]]
+	annotations = []
+	# Walk backwards so the most recent vote of a repeated ID is the one kept
 	for i in reversed(range(num_responses)):
-		if last_col[i] == '':
-			blacklist.append(i)
-			# +2 offset since the API calls are 1-indexed and we must account for header data
-			update_worksheet_cell_safe(worksheet, i + 2, NUM_COLS, "INVALID VOTE! EMPTY ID: " + last_col[i])
-			# Update local data to have this markup
-			all_data[i+1][NUM_COLS - 1] = "INVALID VOTE! EMPTY ID: " + last_col[i]
-		elif last_col[i] not in all_voter_ids:
-			blacklist.append(i)
-			update_worksheet_cell_safe(worksheet, i + 2, NUM_COLS, "INVALID VOTE! UNAUTHORIZED ID: " + last_col[i])
-			all_data[i+1][NUM_COLS - 1] = "INVALID VOTE! UNAUTHORIZED ID: " + last_col[i]
-		elif last_col[i] in encountered_IDs:
-			blacklist.append(i)
-			update_worksheet_cell_safe(worksheet, i + 2, NUM_COLS, "INVALID VOTE! REPEATED ID: " + last_col[i])
-			all_data[i+1][NUM_COLS - 1] = "INVALID VOTE! REPEATED ID: " + last_col[i]
-		else:
-			encountered_IDs[last_col[i]] = True
-
-# Read the private Google spreadsheet holding info for all eligible Avery voters
-def get_all_elgible_email_address():
-	global all_email_addresses
-	global all_first_names
-	global all_full_names
-
-	credentials = ServiceAccountCredentials.from_json_keyfile_name(SECRETS, scopes=SCOPES)
-	gc = gspread.authorize(credentials)
-	sh = gc.open_by_key('1Kodv_Fzz9Oki6q9w14jGddP49XFWD8VnXfFlxyViMVY');
-	email_worksheet = sh.get_worksheet(0)
-	first_col = grab_col_safe(email_worksheet, 1)
-	all_data = grab_all_data_safe(email_worksheet)
-	emails = []
-
-	# Skip over header entry
-	for i in range(1, len(first_col)):
-		if(first_col[i] != ''):
-			row_index = i
+		reason = classify_voter_id(last_col[i], encountered_IDs)
+		if(reason is not None):
+			annotations.append((i, "INVALID VOTE! " + reason + " ID: " + last_col[i]))
+	if(dry_run):
+		return annotations
+
+	for (i, marker) in annotations:
+		blacklist.append(i)
+		# Update local data to have this markup
+		all_data[i + 1][NUM_COLS - 1] = marker
+	return annotations
+
+# Overwrite the voter ID of every blacklisted vote in the worksheet with the marker
+# identify_invalid_votes() left in "all_data", in batches of INVALID_VOTE_BATCH_SIZE cells.
+# Runs after the count so that its Sheets calls stay out of the results report
+def write_invalid_vote_marks():
+	if(blacklist == []):
+		return
+	annotations = [(i, all_data[i + 1][NUM_COLS - 1]) for i in blacklist]
+	# Grab worksheet linked to the current survey once for every batch
+	worksheet = renewed_worksheet()
+	for batch_start in range(0, len(annotations), INVALID_VOTE_BATCH_SIZE):
+		batch = annotations[batch_start : batch_start + INVALID_VOTE_BATCH_SIZE]
+		# +2 offset since the API calls are 1-indexed and we must account for header data
+		update_column_cells_safe(worksheet, NUM_COLS, dict((i + 2, marker) for (i, marker) in batch))
+
+# One eligible voter. Slotted so that campus-sized rosters stay small
+class Voter(object):
+	__slots__ = ["first_name", "full_name", "email"]
+
+	def __init__(self, first_name, full_name, email):
+		self.first_name = first_name
+		self.full_name = full_name
+		self.email = email
+
+# The eligible voters of an election in roster order, indexed by normalized email address.
+# A voter listed again under the same address is kept once and recorded in "duplicates"
+class Roster(object):
+	def __init__(self, voters):
+		self.voters = []
+		self.duplicates = []
+		# Normalized email address -> index into "voters"
+		self.index = {}
+		for voter in voters:
+			key = self.normalize_email(voter.email)
+			if(key in self.index):
+				self.duplicates.append(voter)
+			else:
+				self.index[key] = len(self.voters)
+				self.voters.append(voter)
+
+	def __len__(self):
+		return len(self.voters)
+
+	@staticmethod
+	def normalize_email(email):
+		return email.strip().lower()
+
+	# The voter with email address "email", or None
+	def find(self, email):
+		i = self.index.get(self.normalize_email(email))
+		return None if i is None else self.voters[i]
+
+	# Build the roster from the rows of the roster worksheet, header first
+	@classmethod
+	def from_sheet_rows(cls, rows):
+		voters = []
+		# Skip over header entry
+		for row in rows[1:]:
+			if(row[0] == ''):
+				continue
 			# 1st column is first name, 2nd column is nickname, 3rd column is last
-			full_name = all_data[row_index][0]
-			if(all_data[row_index][1] != ''):
-				first_name = all_data[row_index][1]
-				full_name += ' "' + all_data[row_index][1] + '"'
+			full_name = row[0]
+			if(row[1] != ''):
+				first_name = row[1]
+				full_name += ' "' + row[1] + '"'
 			else:
-				first_name = all_data[row_index][0]
-			full_name += ' ' + all_data[row_index][2]
-			
-			all_first_names.append(first_name)
-			all_full_names.append(full_name)
+				first_name = row[0]
+			full_name += ' ' + row[2]
 			# The 4th column has the email data
-			all_email_addresses.append(all_data[row_index][3])
+			voters.append(Voter(first_name, full_name, row[3].strip()))
+		return cls(voters)
+
+	# The voters as plain (first name, full name, email) lists, as saved in checkpoints
+	def records(self):
+		return [[voter.first_name, voter.full_name, voter.email] for voter in self.voters]
+
+	@classmethod
+	def from_records(cls, records):
+		return cls(Voter(*record) for record in records)
+
+# The roster rows cached in ROSTER_CACHE_FILE if they were saved from ROSTER_SPREADSHEET_KEY
+# at "revision", else None
+def read_roster_cache(revision):
+	try:
+		with open(ROSTER_CACHE_FILE, "r") as file:
+			cache = json.load(file)
+	except (IOError, ValueError):
+		return None
+	if(cache.get("key") != ROSTER_SPREADSHEET_KEY or cache.get("revision") != revision):
+		return None
+	return cache.get("rows")
+
+def write_roster_cache(revision, rows):
+	temp_file_name = ROSTER_CACHE_FILE + ".tmp"
+	with open(temp_file_name, "w") as file:
+		json.dump({"key": ROSTER_SPREADSHEET_KEY, "revision": revision, "rows": rows}, file)
+	replace_file(temp_file_name, ROSTER_CACHE_FILE)
+
+# Load the eligible voters into global variable "roster". The roster worksheet is only
+# downloaded, in one read, when it was edited since it was last cached. The handle is
+# fetched fresh every time so that its revision is current. A worksheet without a revision
+# is always downloaded
+def load_roster():
+	global roster
+	email_worksheet = call_sheets_api("Roster revision", \
+	lambda worksheet: sheets_session.worksheet(ROSTER_SPREADSHEET_KEY, 0, fresh=True), cost=0)
+	revision = getattr(email_worksheet, 'updated', None)
+	rows = read_roster_cache(revision) if revision is not None else None
+	if(rows is None):
+		rows = grab_all_data_safe(email_worksheet)
+		if(revision is not None):
+			write_roster_cache(revision, rows)
+	else:
+		print_write("Using the roster cached at revision " + revision)
+	roster = Roster.from_sheet_rows(rows)
+	for voter in roster.duplicates:
+		print_write("Duplicate roster entry skipped: " + voter.full_name + " <" + voter.email + ">", "WARNING")
+	print_write("Eligible voters: " + str(len(roster)))
 
 # delete sent folder to ensure voter anonymity. This prevents association of
 # voter ID with email address and prevents pins from being recovered
 def delete_sent_folder(sender, password):
-	m = imaplib.IMAP4_SSL("imap.gmail.com")  # server to connect to
-	m.login(sender, password)
+	with metrics.timed("imap_seconds", "Login"):
+		m = imaplib.IMAP4_SSL("imap.gmail.com")  # server to connect to
+		m.login(sender, password)
 
 	# Move sent folder to trash
 	print_write("Moving sent folder to trash... ")
-	print_write(str(m.select('[Gmail]/Sent Mail')))
-	m.store("1:*",'+X-GM-LABELS', '\\Trash')
-	m.expunge()
+	with metrics.timed("imap_seconds", "Move sent folder to trash"):
+		print_write(str(m.select('[Gmail]/Sent Mail')), "DEBUG")
+		m.store("1:*",'+X-GM-LABELS', '\\Trash')
+		m.expunge()
 	
 	#This block empties trash
 	print_write("Emptying Trash...")
-	print_write(str(m.select('[Gmail]/Trash')))  # select all trash
-	m.store("1:*", '+FLAGS', '\\Deleted')  #Flag all Trash as Deleted
-	m.expunge()  # not need if auto-expunge enabled
+	with metrics.timed("imap_seconds", "Empty trash"):
+		print_write(str(m.select('[Gmail]/Trash')), "DEBUG")  # select all trash
+		m.store("1:*", '+FLAGS', '\\Deleted')  #Flag all Trash as Deleted
+		m.expunge()  # not need if auto-expunge enabled
 
-	m.close()
-	m.logout()
+	with metrics.timed("imap_seconds", "Logout"):
+		m.close()
+		m.logout()
 	print_write("Sent folder successfully deleted.\n")	
 
 
+# Shared cap on the rate of outgoing emails
+smtp_rate_limiter = TokenBucket(SMTP_MAX_SENDS_PER_SECOND, SMTP_MAX_SENDS_PER_SECOND, "SMTP rate limit")
+
+# Whether a failed SMTP call never got an answer from the mail server
+def is_connection_error(error):
+	return isinstance(error, (socket.error, smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError))
+
+# Open a connection to the outgoing mail server, logged in as HOST_GMAIL_ACCOUNT
+def smtp_connect(gmail_password):
+	metrics.count("smtp_connections_total")
+	with metrics.timed("smtp_seconds", "Connect"):
+		server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
+		server.ehlo()
+		if(SMTP_USE_TLS):
+			server.starttls()
+		if(gmail_password is not None):
+			server.login(HOST_GMAIL_ACCOUNT, gmail_password)
+	return server
+
+# Send every (recipient, message) pair of "emails" over a pool of SMTP_POOL_SIZE
+# connections. "emails" may be a generator so that messages are only built once a
+# connection is ready for them. A connection that fails is dropped and reopened for the
+# next attempt, and lost connections count towards the shared connection_breaker. Exits
+# if an email still fails after SMTP_MAX_ATTEMPTS attempts. "first_sent", if given, is a
+# threading.Event set as soon as the first email is out. Returns the number of emails
+# sent, fewer than "num_emails" if "emails" ran out early. Failed emails are not counted.
+def deliver_emails(emails, num_emails, gmail_password, first_sent=None):
+	emails = iter(emails)
+	log = current_log()
+	lock = threading.Lock()
+	progress = {'sent': 0, 'last_report': time.time()}
+	failed_recipients = []
+	start_time = time.time()
+
+	def next_email():
+		with lock:
+			return next(emails, None)
+
+	def report_progress():
+		if(first_sent is not None):
+			first_sent.set()
+		with lock:
+			progress['sent'] += 1
+			now = time.time()
+			if(now - progress['last_report'] < SMTP_PROGRESS_INTERVAL and progress['sent'] != num_emails):
+				return
+			progress['last_report'] = now
+			rate = progress['sent'] / max(now - start_time, 1e-6)
+			print "Emails sent: " + str(progress['sent']) + " / " + str(num_emails) \
+			+ " (%.1f messages/sec)" % rate
+
+	def worker():
+		log_context.log = log
+		server = None
+		email = next_email()
+		while(email is not None):
+			recipient, message = email
+			times_attempted = 0
+			sent = False
+			while(True):
+				times_attempted += 1
+				try:
+					connection_breaker.wait()
+					if(server is None):
+						server = smtp_connect(gmail_password)
+					smtp_rate_limiter.acquire()
+					with metrics.timed("smtp_seconds", "Send"):
+						server.sendmail(HOST_GMAIL_ACCOUNT, recipient, message)
+					connection_breaker.record_success()
+					metrics.count("emails_sent_total")
+					metrics.count("email_bytes_sent_total", amount=len(message))
+					sent = True
+					break
+				except Exception as e:
+					print_write("Previous email failed (" + str(e) + "). Retying email to " + recipient, "WARNING")
+					metrics.count("email_retries_total")
+					try:
+						server.close()
+					except:
+						pass
+					server = None
+					if(times_attempted >= SMTP_MAX_ATTEMPTS):
+						with lock:
+							failed_recipients.append(recipient)
+						break
+					if(is_connection_error(e)):
+						connection_breaker.record_failure()
+						if(connection_breaker.is_open()):
+							continue
+					else:
+						connection_breaker.record_success()
+					wait = min(RETRY_INITIAL_BACKOFF * 2 ** times_attempted, RETRY_MAX_BACKOFF)
+					time.sleep(wait)
+					metrics.count("sleep_seconds_total", "SMTP retry backoff", wait)
+			if(sent):
+				report_progress()
+			email = next_email()
+		if(server is not None):
+			try:
+				server.quit()
+			except:
+				pass
+
+	workers = [threading.Thread(target=worker) for i in range(SMTP_POOL_SIZE)]
+	for thread in workers:
+		thread.daemon = True
+		thread.start()
+	for thread in workers:
+		# join() with a timeout keeps the main thread responsive to Ctrl-C
+		while(thread.is_alive()):
+			thread.join(1)
+	if(failed_recipients != []):
+		print_write("FATAL: unable to send email to " + ", ".join(failed_recipients) + " (" \
+		+ str(progress['sent']) + " / " + str(num_emails) + " delivered)", "ERROR")
+		sys.exit(-1)
+	elapsed = max(time.time() - start_time, 1e-6)
+	print_write("Delivered " + str(progress['sent']) + " emails in " + str(int(elapsed)) + " seconds (%.1f messages/sec)" % (progress['sent'] / elapsed))
+	return progress['sent']
+
+# Shared by every BackgroundJob
+background_slots = threading.BoundedSemaphore(BACKGROUND_WORKERS)
+
+# Run "function" on a thread of its own, so that elections keep polling while it blocks on
+# a mail server. At most BACKGROUND_WORKERS jobs run at once, the others wait for a slot.
+# The job logs to the election it was started from. A fatal error is kept and raised
+# again by result(), in the thread that asks for it.
+class BackgroundJob(object):
+	def __init__(self, function):
+		self.function = function
+		self.log = current_log()
+		self.error = None
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		log_context.log = self.log
+		with background_slots:
+			try:
+				self.function()
+			except BaseException:
+				self.error = sys.exc_info()
+
+	def done(self):
+		return not self.thread.is_alive()
+
+	# Wait for the job to finish and raise its error, if it had one
+	def result(self):
+		# join() with a timeout keeps the main thread responsive to Ctrl-C
+		while(self.thread.is_alive()):
+			self.thread.join(1)
+		if(self.error is not None):
+			raise self.error[0], self.error[1], self.error[2]
+
+# Number of rows of "data" up to the first one with a blank timestamp, header included.
+# Same count as get_num_responses() + 1 without another trip to the spreadsheet.
+def get_num_rows_in(data):
+	num_rows = 0
+	for row in data:
+		if(row[0] == ''):
+			break
+		num_rows += 1
+	return num_rows
+
+# Encode a cell for the csv module, which only handles byte strings in Python 2
+def csv_cell(value):
+	if(isinstance(value, unicode)):
+		return value.encode('utf-8')
+	return value
+
+# Stream the in-memory vote data into raw_votes.<format> for every format in
+# RAW_VOTES_FORMATS. The xlsx is written row by row in constant memory mode and its
+# column widths are worked out in the same pass. Returns the names of the files written.
+def export_raw_votes():
+	num_rows = get_num_rows_in(all_data)
+	file_names = []
+	writers = []
+	open_files = []
+	workbook = None
+	for file_format in RAW_VOTES_FORMATS:
+		this_file_name = output_path('raw_votes.' + file_format)
+		if(file_format == 'xlsx'):
+			workbook = xlsxwriter.Workbook(this_file_name, {'constant_memory': True})
+			output_xlsx_file = workbook.add_worksheet()
+		elif(file_format == 'csv'):
+			open_files.append(open(this_file_name, 'wb'))
+			writers.append(csv.writer(open_files[-1]))
+		elif(file_format == 'csv.gz'):
+			open_files.append(gzip.open(this_file_name, 'wb'))
+			writers.append(csv.writer(open_files[-1]))
+		else:
+			print_write("FATAL: unknown raw vote format " + file_format, "ERROR")
+			sys.exit(-1)
+		file_names.append(this_file_name)
+
+	column_widths = [0] * NUM_COLS
+	for i in range(num_rows):
+		row = all_data[i][0:NUM_COLS]
+		if(workbook is not None):
+			output_xlsx_file.write_row(i, 0, row)
+		for writer in writers:
+			writer.writerow([csv_cell(value) for value in row])
+		for j in range(NUM_COLS):
+			column_widths[j] = max(column_widths[j], len(row[j]))
+
+	# Widen columns appropriately
+	if(workbook is not None):
+		for j in range(NUM_COLS):
+			output_xlsx_file.set_column(j, j, min(column_widths[j] + 2, MAX_XLSX_COLUMN_WIDTH))
+		workbook.close()
+	for open_file in open_files:
+		open_file.close()
+	return file_names
+
+# Write the name and email address of every eligible voter into eligible_voters.xlsx.
+# Returns the file name.
+def export_eligible_voters():
+	this_file_name = output_path('eligible_voters.xlsx')
+	workbook = xlsxwriter.Workbook(this_file_name, {'constant_memory': True})
+	output_xlsx_file = workbook.add_worksheet()
+	for i, voter in enumerate(roster.voters):
+		output_xlsx_file.write_row(i, 0, [voter.full_name, voter.email])
+	# Widen columns appropriately
+	output_xlsx_file.set_column(0, 1, 30)
+	workbook.close()
+	return this_file_name
+
+# Read and encode the files attached to every results email. Returns the tail of a
+# multipart message with the given boundary: one part per file followed by the closing
+# boundary, so it can follow the text part of any recipient's message unchanged.
+def build_shared_attachments(file_names, boundary):
+	attachments = ''
+	for file_name in file_names:
+		with open(file_name, "rb") as fil:
+			part = MIMEApplication(
+				fil.read(),
+				Content_Disposition='attachment; filename="%s"' % basename(file_name),
+				Name=basename(file_name)
+				)
+		attachments += '\n--' + boundary + '\n' + part.as_string()
+	return attachments + '\n--' + boundary + '--\n'
+
 # Send the following data to all eligible voters:
 # 1) list of all email addresses invited to the survey (not visible to public)
-# 2) text file of instant runoff results containing all program output
+# 2) text file with the report of the count (RESULTS_REPORT_FILE)
 # 3) xlsx file of the raw vote counts pulled directly from the Google spreadsheet
+# The files are written and encoded here, and the emails go out on a BackgroundJob that
+# only uses what it is given, so other elections keep polling meanwhile. Returns the job
 def email_results(gmail_password):
-	global RESULTS_STRING
-	num_averites = len(all_email_addresses)
-	if(num_averites == 0):
-		print_write('FATAL: No email addresses')
+	if(roster is None or len(roster) == 0):
+		print_write('FATAL: No email addresses', "ERROR")
 		sys.exit(-1)
 	elif(SUBJECT == ''):
-		print_write('FATAL: No subject line')
+		print_write('FATAL: No subject line', "ERROR")
 		sys.exit(-1)
-	elif(all_output == ''):
-		print_write('FATAL: No output')
+	elif(election_log.num_report_records == 0):
+		print_write('FATAL: No results report', "ERROR")
 		sys.exit(-1)
 	elif(all_data == []):
-		print_write('FATAL: no spreadsheet data')
+		print_write('FATAL: no spreadsheet data', "ERROR")
 		sys.exit(-1)
 	elif(NUM_COLS == -1):
-		print_write("FATAL: number of spreadsheet columns not specified")
+		print_write("FATAL: number of spreadsheet columns not specified", "ERROR")
 		sys.exit(-1)
 	elif(all_survey_ids == []):
-		print_write("FATAL: Survey IDs not generated")
+		print_write("FATAL: Survey IDs not generated", "ERROR")
 		sys.exit(-1)
+	num_averites = len(roster)
 		
 	# Array of all filenames to send
 	all_files = []
 	
-	print_write("\nCreating xlsx file with vote data...")
-	# Create an new Excel file and add a worksheet.
-	this_file_name = 'raw_votes.xlsx'
-	workbook = xlsxwriter.Workbook(this_file_name)
-	output_xlsx_file = workbook.add_worksheet()
-	# Write data with row/column notation.
-	num_rows = get_num_responses() + 1
-	for i in range(num_rows):
-		for j in range(NUM_COLS):
-			output_xlsx_file.write(i, j, all_data[i][j])
-	# Widen columns appropriately
-	for i in range(NUM_COLS):
-		if(i == 0):
-			output_xlsx_file.set_column(i,i, 20) # timestamp col
-		elif(i == NUM_COLS - 1):
-			output_xlsx_file.set_column(i,i, VOTER_ID_LENGTH + 30) # voter ID col
-		else:
-			output_xlsx_file.set_column(i,i, len(all_data[0][i])) # every other col
-	workbook.close()
+	print_write("\nExporting vote data...")
+	raw_vote_files = export_raw_votes()
 	print_write("SUCCESS!")
-	all_files.append(this_file_name)
+	all_files += raw_vote_files
 	
 	print_write("Creating xlsx file with eligible voter data...")
-	# Create an new Excel file and add a worksheet.
-	this_file_name = 'eligible_voters.xlsx'
-	workbook = xlsxwriter.Workbook(this_file_name)
-	output_xlsx_file = workbook.add_worksheet()
-	# Write data with row/column notation.
-	num_rows = len(all_first_names)
-	cols = 2
-	for i in range(num_rows):
-		output_xlsx_file.write(i, 0, all_full_names[i])
-		output_xlsx_file.write(i, 1, all_email_addresses[i])
-	# Widen columns appropriately
-	for i in range(cols):
-		output_xlsx_file.set_column(i,i, 30)
-	workbook.close()
+	all_files.append(export_eligible_voters())
 	print_write("SUCCESS!")
 	
-	all_files.append(this_file_name)
-	
-	# Create text file with runoff results
-	this_file_name = "runoff_results.txt"
+	# The report of the count was written as the votes were tabulated
+	all_files.append(output_path(RESULTS_REPORT_FILE))
 	print_write("Sending results emails.")
-	file = open(this_file_name, "w")
-	file.write(all_output)
-	file.close()
-	all_files.append(this_file_name)
 	
 	sender = HOST_GMAIL_ACCOUNT
-	server = smtplib.SMTP("smtp.gmail.com", 587)
-	server.ehlo()
-	server.starttls()
-	server.login(sender, gmail_password)
 	FROM = sender
+	# Read and encode every attachment once. Recipients only differ in their text part
+	boundary = '===============' + str(random_with_N_digits(19)) + '=='
+	attachments = build_shared_attachments(all_files, boundary)
+	voters = roster.voters
+	survey_ids = list(all_survey_ids)
+	subject = SUBJECT
+	results_string = RESULTS_STRING
 	
-	# Send name-tailored email to every eligible voter with their custom pin
-	for i in range(num_averites):
-		try:
-			TO = all_email_addresses[i]
-			TEXT = "Hi again " + all_first_names[i] + ', ' \
+	# Build the name-tailored email of every eligible voter with their custom pin
+	def results_emails():
+		for i in range(num_averites):
+			TO = voters[i].email
+			TEXT = "Hi again " + voters[i].first_name + ', ' \
 			+ "\n\nThe survey has closed and the votes have been counted.\n" \
-			+ RESULTS_STRING \
+			+ results_string \
 			+ "\nAll email addresses that were sent a link are in eligible_voters.xlsx" \
-			+ "\nRaw vote data is in raw_votes.xlsx" \
-			+ "\nRunoff results are in runoff_results.txt" \
+			+ "\nRaw vote data is in " + ", ".join(map(basename, raw_vote_files)) \
+			+ "\nRunoff results are in " + RESULTS_REPORT_FILE \
 			+ "\n\nThank you for keeping Avery great," \
 			+ "\n\n<3 your ExComm" \
-			+ "\nSurvey ID (should match the first email): " + str(all_survey_ids[i]) \
+			+ "\nSurvey ID (should match the first email): " + str(survey_ids[i]) \
 			+ "\nGithub repo: https://github.com/jordanbonilla/OnlineVoting"
 
 			# Prepare actual message
-			message = MIMEMultipart()
+			message = MIMEMultipart(boundary=boundary)
 			message['From'] = FROM
 			message['To'] = TO
-			message['Subject'] = "*RESULTS* " + SUBJECT
+			message['Subject'] = "*RESULTS* " + subject
 			message.attach(MIMEText(TEXT))
+			# Swap the closing boundary for the already encoded attachments
+			personal_part = message.as_string()
+			yield TO, personal_part[:personal_part.rindex('\n--' + boundary + '--')] + attachments
 
-			# Attach all files
-			for j in range(len(all_files)):
-				file_name = all_files[j]
-				with open(file_name, "rb") as fil:
-					message.attach(MIMEApplication(
-						fil.read(),
-						Content_Disposition='attachment; filename="%s"' % basename(file_name),
-						Name=basename(file_name)
-						))
-			# Send
-			server.sendmail(FROM, TO, message.as_string())
-		except:
-			email_recovery(server, FROM, TO, message.as_string(), TO)
-		# Don't risk sending too many emails in too short a time span
-		time.sleep(2)
-		# Write progress to local terminal
-		sys.stdout.write('\r')
-		sys.stdout.write("[%-20s] %d%%" % ('='*(20 * (i+1)/num_averites), 100 * (i+1)/num_averites))
-		sys.stdout.flush()
-	
-	print_write("\nSuccess. Total number of emails sent: " + str(num_averites) + " / " + str(num_averites))
-	delete_sent_folder(sender, gmail_password)
-	server.quit()
+	def send_results():
+		with metrics.timed("email_batch_seconds", "Results"):
+			num_sent = deliver_emails(results_emails(), num_averites, gmail_password)
+		print_write("Success. Total number of emails sent: " + str(num_sent) + " / " + str(num_averites))
+
+	return BackgroundJob(send_results)
 
-# Send links to the survey, along with the unique voter IDs (embedded in URL), and survey pin
-def email_the_links(gmail_password):
+# Generate the voter IDs and pins, then send links to the survey, along with the unique
+# voter IDs (embedded in URL) and survey pins, on a BackgroundJob that also clears the sent
+# folder once they are all out. "first_sent" is set as soon as the first link is out.
+# Once "canceled" is set no more links are sent, though the sent folder is still cleared.
+# Returns the job
+def email_the_links(gmail_password, first_sent, canceled):
 	print_write("Sending emails to all eligible voters...")
-	if(all_email_addresses == []):
-		print_write("FATAL: no email addresses loaded")
-		sys.exit(-1)
-	num_averites = len(all_email_addresses)
-	if(num_averites == 0):
-		print_write('FATAL: No email addresses')
+	if(roster is None or len(roster) == 0):
+		print_write("FATAL: no email addresses loaded", "ERROR")
 		sys.exit(-1)
-	elif(SUBJECT == ''):
-		print_write('FATAL: No subject line')
+	num_averites = len(roster)
+	if(SUBJECT == ''):
+		print_write('FATAL: No subject line', "ERROR")
 		sys.exit(-1)
 		
 	sender = HOST_GMAIL_ACCOUNT
-	server = smtplib.SMTP("smtp.gmail.com", 587)
-	server.ehlo()
-	server.starttls()
-
-	server.login(sender, gmail_password)
 	FROM = sender
 
-	global all_voter_ids
 	global all_survey_ids
-	unique_urls = []
-	# Generate voter IDs and pins
-	used_voter_ids = {}
-	message = None
+	# Generate pins. Voter IDs are generated one at a time as their emails go out and are
+	# not kept: the election key is enough to validate them
+	if(ELECTION_KEY == ''):
+		generate_election_key()
 	for i in range(num_averites):
-		this_voter_id = random_with_N_digits(VOTER_ID_LENGTH)
-		while(this_voter_id in used_voter_ids):
-			this_voter_id = random_with_N_digits(VOTER_ID_LENGTH)
-		used_voter_ids[this_voter_id] = True
-		all_voter_ids.append(str(this_voter_id))
 		all_survey_ids.append(str(random_with_N_digits(SURVEY_ID_LENGTH)))
-		unique_urls.append(survey_url + all_voter_ids[i])
 		
 	BODY = \
 			textwrap.fill("This is a unique link assigned to you. For this reason, " \
@@ -668,65 +1502,136 @@ def email_the_links(gmail_password):
 			+ "that you have your unique pin and url on file should a vote's legitimacy " \
 			+ "fall into question.") \
 			
-	for i in range(num_averites):
-		try:
-			TO = all_email_addresses[i]
-			TEXT = "Hi " + all_first_names[i] + ', ' \
-			+ "\n\nHere is your link to vote: \n" + unique_urls[i] \
+	# The job runs while other elections are entered, so it only uses what it is given here
+	voters = roster.voters
+	survey_ids = list(all_survey_ids)
+	subject = SUBJECT
+	url_prefix = survey_url
+	election_key = ELECTION_KEY
+	def link_emails():
+		for i in range(num_averites):
+			if(canceled.is_set()):
+				return
+			TO = voters[i].email
+			TEXT = "Hi " + voters[i].first_name + ', ' \
+			+ "\n\nHere is your link to vote: \n" + url_prefix + new_voter_id(election_key) \
 			+ "\n\n" + BODY \
 			+ "\n\nThank you for keeping Avery great," \
 			+ "\n\n<3 your ExComm" \
-			+ "\nSurvey ID: " + str(all_survey_ids[i]) \
+			+ "\nSurvey ID: " + str(survey_ids[i]) \
 			+ "\nGithub repo: https://github.com/jordanbonilla/OnlineVoting"
 			# Prepare actual message
 			message = """\From: %s\nTo: %s\nSubject: %s\n\n%s
-			""" % (FROM, TO, SUBJECT, TEXT)
-			server.sendmail(FROM, TO, message)
-		except:
-			email_recovery(server, FROM, TO, message, TO)
-		# Don't risk sending too many emails in too short a time span
-		time.sleep(2)
-		# Write progress to local terminal
-		sys.stdout.write('\r')
-		sys.stdout.write("[%-20s] %d%%" % ('='*(20 * (i+1)/num_averites), 100 * (i+1)/num_averites))
-		sys.stdout.flush()
-		
-	print_write("\nAll unique links sent. Total number of emails sent: " + str(num_averites) + " / " + str(num_averites))
-	
-	delete_sent_folder(sender, gmail_password)
-	server.quit()
+			""" % (FROM, TO, subject, TEXT)
+			yield TO, message
+
+	def send_links():
+		with metrics.timed("email_batch_seconds", "Links"):
+			num_sent = deliver_emails(link_emails(), num_averites, gmail_password, first_sent)
+		if(num_sent < num_averites):
+			print_write("Sending links canceled. Total number of emails sent: " + str(num_sent) + " / " + str(num_averites), "WARNING")
+		else:
+			print_write("All unique links sent. Total number of emails sent: " + str(num_sent) + " / " + str(num_averites))
+		delete_sent_folder(sender, gmail_password)
+
+	return BackgroundJob(send_links)
+
+# Parse the header of the voter data worksheet into the positions on the ballot of a
+# "vote_type" vote. Returns the position names, the candidates of each position and the
+# (first column, number of columns) pair of each position. In a referendum every
+# column is its own position and the options are whatever voters answered, so
+# its candidate lists are empty.
+def parse_positions(first_row, vote_type):
+	position_names = []
+	position_candidates = []
+	position_columns = []
+	# Skip first col (timestamp), last col (unique ID)
+	for i in range(1, len(first_row) - 1):
+		if(vote_type == "referendum"):
+			position_names.append(first_row[i])
+			position_candidates.append([])
+			position_columns.append((i, 1))
+			continue
+		parsed = first_row[i].split('[')
+		this_position = parsed[0]
+		this_candidate = parsed[1][:-1]
+		if(this_position not in position_names):
+			position_names.append(this_position)
+			position_candidates.append([this_candidate])
+			position_columns.append((i, 1))
+		else:
+			position_candidates[-1].append(this_candidate)
+			position_columns[-1] = (position_columns[-1][0], position_columns[-1][1] + 1)
+	return position_names, position_candidates, position_columns
+
+# Collapse the valid ballots of every position into unique (pattern, weight) pairs so
+# tabulation scales with the number of distinct ballots rather than the number of voters.
+# "position_columns" holds a (first column, number of columns) pair per position
+def compress_ballots(position_columns, num_responses):
+	global compressed_ballots
+	if(all_data == []):
+		print_write("FATAL: voter data not loaded into global variable all_data", "ERROR")
+		sys.exit(-1)
+	compressed_ballots = [{} for position in position_columns]
+	excluded = set(blacklist)
+	for i in range(num_responses):
+		if(i in excluded):
+			continue
+		row = all_data[i + 1] # +1 to skip header row
+		for position_num in range(len(position_columns)):
+			start_index, width = position_columns[position_num]
+			pattern = tuple(row[start_index : start_index + width])
+			patterns = compressed_ballots[position_num]
+			patterns[pattern] = patterns.get(pattern, 0) + 1
+
+# Fill global variable "compressed_ballots", from the running tally of "snapshot" when
+# there is one since it already holds the valid ballots compressed
+def load_compressed_ballots(snapshot, position_columns, num_responses):
+	global compressed_ballots
+	if(snapshot is not None and snapshot.tally is not None):
+		compressed_ballots = snapshot.tally.ballots()
+	else:
+		compress_ballots(position_columns, num_responses)
+
+# Load the votes to tabulate into global variable "all_data" and return how many there are.
+# Uses the votes the last poll already fetched when given its snapshot, otherwise downloads them
+def load_all_data(snapshot):
+	global all_data
+	if(snapshot is not None):
+		all_data = snapshot.all_data()
+		return snapshot.num_responses()
+	worksheet = renewed_worksheet()
+	num_responses = get_num_responses_on_recently_renewed_worksheet(worksheet)
+	all_data = grab_all_data_safe(worksheet)
+	return num_responses
 
 # Read in results from spreadsheet holding voter data and calculate winners using a direct referendum vote
-def get_results_referendum():
+def get_results_referendum(snapshot=None):
 	global RESULTS_STRING
 	global all_data
 	if(WORKSHEET_TITLE == ''):
-		print_write("FATAL: no worksheet title specified")
+		print_write("FATAL: no worksheet title specified", "ERROR")
 		sys.exit(-1)
 		
-	worksheet = renewed_worksheet()
-	num_responses = get_num_responses_on_recently_renewed_worksheet(worksheet)
-	
-	all_data = grab_all_data_safe(worksheet)
+	num_responses = load_all_data(snapshot)
 	# Identify votes that are are invalid
 	identify_invalid_votes(num_responses) 
 	positions_encountered = {}
 	first_row = get_first_row_cleaned_from_all_data()
+	position_columns = parse_positions(first_row, "referendum")[2]
+	load_compressed_ballots(snapshot, position_columns, num_responses)
 	# Grab all position names
-	# Skip first col (timestamp), last col (unique ID)
 	for i in range(1, len(first_row) - 1):
 		this_position = first_row[i]
 		positions_encountered[this_position] = {}
 		relevant_dictionary = positions_encountered[this_position]
-		relevant_col = [row[i] for row in all_data]
-		# iterate over all votes for this position, skipping header element
-		for j in range(1, num_responses + 1):
-			this_vote = relevant_col[j]
-			if(j - 1 not in blacklist): # Blacklist uses index 0 for vote 0
-				if(this_vote not in relevant_dictionary):
-					relevant_dictionary[this_vote] = 1
-				else:
-					relevant_dictionary[this_vote] += 1	
+		# Each single-column pattern is one answer and its weight the number of such votes
+		for pattern, weight in compressed_ballots[i - 1].items():
+			this_vote = pattern[0]
+			if(this_vote not in relevant_dictionary):
+				relevant_dictionary[this_vote] = weight
+			else:
+				relevant_dictionary[this_vote] += weight
 
 
 	print_write("Number of votes cast in this survey: " + str(num_responses))
@@ -762,74 +1667,73 @@ def get_results_referendum():
 
 
 
-# Read in results from spreadsheet holding voter data and calculate winners based on IRV strategy
-def get_results_IRV():
-	global all_data
-	global RESULTS_STRING
+# Load the votes of a ranked vote of "vote_type" ("IRV", "STV" or "condorcet"), mark the
+# invalid ones and compress the ballots of every position, then log the vote counts and
+# the candidates of every position, along with its seats in an STV vote. Returns the
+# position names and the candidates of each position.
+def load_ranked_vote(vote_type, snapshot):
 	if(WORKSHEET_TITLE == ''):
-		print_write("FATAL: no worksheet title specified")
+		print_write("FATAL: no worksheet title specified", "ERROR")
 		sys.exit(-1)
 		
-	worksheet = renewed_worksheet()
-	num_responses = get_num_responses_on_recently_renewed_worksheet(worksheet)
-	
-	all_data = grab_all_data_safe(worksheet)
-	position_delimiters = []
-	positions_encountered = {}
+	num_responses = load_all_data(snapshot)
 	first_row = get_first_row_cleaned_from_all_data()
-	
-	position_names = []
-	candidates_adjoined = []
 	# Grab names of candidates cooresponding to each position
-	# Skip first col (timestamp), last col (unique ID)
-	for i in range(1, len(first_row) - 1):
-		parsed = first_row[i].split('[')
-		this_position = parsed[0]
-		this_candidate = parsed[1][:-1]
-		if(this_position not in position_names):
-			position_delimiters.append(i)
-			positions_encountered[this_position] = True
-			position_names.append(this_position)
-			candidates_adjoined.append(this_candidate)
-			
-		else:
-			candidates_adjoined[-1] += ('\t' + this_candidate)
+	position_names, candidates_split, position_columns = parse_positions(first_row, vote_type)
 	
 	print_write("Number of votes cast in this survey: " + str(num_responses))
 	# Identify votes that are are invalid
 	identify_invalid_votes(num_responses)
+	load_compressed_ballots(snapshot, position_columns, num_responses)
 	num_invalid = len(blacklist)
 	print_write("Number of invalid votes: " + str(num_invalid))
 	print_write("Number of valid votes: " + str(num_responses - num_invalid))
 	print_write("Refer to raw vote data for more information")
-	num_positions = len(candidates_adjoined)
+	num_positions = len(position_names)
 	print_write("\nNumber of positions to assign in this election: " + str(num_positions))
 	
-	# Split the adjoined candidate lists
-	candidates_split = []
 	for i in range(num_positions):
 		print_write("\nPosition Title: " + position_names[i])
-		all_candidates_for_this_position = candidates_adjoined[i].split('\t')
-		candidates_split.append(all_candidates_for_this_position)
-		for j in range(len(all_candidates_for_this_position)):
-			print_write("    Candidate #" + str(j + 1) + ": " + all_candidates_for_this_position[j])
+		if(vote_type == "STV"):
+			print_write("    Seats: " + str(stv_seats(num_positions)[i]))
+		for j in range(len(candidates_split[i])):
+			print_write("    Candidate #" + str(j + 1) + ": " + candidates_split[i][j])
+	return position_names, candidates_split
+
+# Read in results from spreadsheet holding voter data and calculate winners based on IRV strategy
+def get_results_IRV(snapshot=None):
+	global RESULTS_STRING
+	position_names, candidates_split = load_ranked_vote("IRV", snapshot)
+	num_positions = len(position_names)
 
 	# Find the winners
 	RESULTS_STRING = "Winners:\n"
 	print_write('\nBegin Runoff\n_____________________________________________')
-	for i in range(num_positions):
+	def count_position(i):
+		global RESULTS_STRING
 		print_write(position_names[i])
 		num_candidates = len(candidates_split[i])
 		remaining_candidates = range(num_candidates)
-		start_index = position_delimiters[i] # starting column
+		# Parse this position's ballot patterns once. Rounds only flip entries of the mask
+		ranks, weights = build_rank_matrix(compressed_ballots[i], num_candidates)
+		in_race = np.ones(num_candidates, dtype=bool)
+		if(IRV_MODE == "incremental"):
+			count_votes = BallotBuckets(ranks, weights).count
+		else:
+			count_votes = lambda in_race: count_first_preferences(ranks, weights, in_race)
 		RESULTS_STRING += position_names[i] + ": "
 		# Proceed with runoff
 		round_num = 1
+		# (counts, candidates in the round, majority reached) of every round
+		rounds = []
 		while(len(remaining_candidates) > 1):
 			print_write("Round: " + str(round_num))
 			count_spread = [0] * num_candidates
-			run_off(count_spread, remaining_candidates, start_index, num_candidates, \
-			num_positions, num_responses)
+			candidates_in_round = list(remaining_candidates)
+			run_off(count_spread, remaining_candidates, in_race, count_votes, \
+			compressed_ballots[i])
+			rounds.append((list(count_spread), candidates_in_round, \
+			max(count_spread) * 2 > sum(count_spread)))
 			for j in range(num_candidates):
 				if(j in remaining_candidates or count_spread[j] is not 0):
 					print_write("    " + candidates_split[i][j] + " - " + str(count_spread[j]))
@@ -842,46 +1746,270 @@ def get_results_IRV():
 					print_write("    Advance: " + candidates_split[i][j])
 			round_num = round_num + 1
 			print_write('')
+		if(CONDORCET_CROSS_CHECK_IRV):
+			schulze = schulze_winners(pairwise_preferences(ranks, weights))[0]
+			print_write("    Schulze cross-check winner: " \
+			+ ", ".join(candidates_split[i][j] for j in schulze))
+		if(len(remaining_candidates) == 1):
+			if(IRV_MARGIN_ANALYSIS):
+				print_irv_margins(rounds, remaining_candidates[0], candidates_split[i])
+			if(IRV_BOOTSTRAP_SAMPLES > 0):
+				print_irv_stability(ranks, weights, remaining_candidates[0], candidates_split[i])
 		print_write('\n_____________________________________________')
+	tabulate_positions(count_position, num_positions)
+
+# Upper bounds on how many ballots would have to change to alter the outcome of an IRV
+# count, from its "rounds" as recorded by get_results_IRV. Every bound exhausts ballots
+# that rank one candidate first, or ranks another candidate first on them instead, which
+# shifts the counts of those two by the same amount in every round and leaves all others
+# alone, so the count is unchanged up to the round targeted unless the outcome changes
+# earlier. Majority rounds are bounded whatever the number of candidates in them.
+# Returns (winner bound, elimination order bound, gap of every elimination round). A bound
+# is None when no candidate has enough first preferences to move.
+def irv_margin_bounds(rounds, winner):
+	first_preferences = rounds[0][0]
+	winner_bound = None
+	order_bound = None
+	gaps = []
+	for counts, candidates, majority in rounds:
+		others = [j for j in candidates if j != winner]
+		lowest = min(counts[j] for j in others)
+		# Exhaust enough first preferences of the winner to make them the lowest
+		costs = [counts[winner] - lowest + 1]
+		if(majority):
+			# Or rank the runner-up first instead until it holds the majority, which closes the
+			# gap twice as fast. Whoever else is in the round doesn't matter
+			runner_up = max(counts[j] for j in others)
+			costs.append(sum(counts) // 2 - runner_up + 1)
+		for cost in costs:
+			if(cost <= first_preferences[winner] and (winner_bound is None or cost < winner_bound)):
+				winner_bound = cost
+		if(majority):
+			# Exhaust just enough first preferences of the winner to lose the majority, so the
+			# count goes on to eliminate the lowest candidate of the round instead of ending
+			cost = 2 * counts[winner] - sum(counts)
+			if(len(candidates) > 2 and cost <= first_preferences[winner] \
+			and (order_bound is None or cost < order_bound)):
+				order_bound = cost
+			continue
+		# Lift an eliminated candidate over the lowest one that carried on, by ranking it
+		# first on ballots that ranked the one that carried on first
+		eliminated = [j for j in candidates if counts[j] == min(counts[k] for k in candidates)]
+		carried_on = [j for j in candidates if j not in eliminated]
+		if(carried_on == []):
+			continue
+		next_lowest = min(carried_on, key=lambda j: counts[j])
+		gap = counts[next_lowest] - counts[eliminated[0]]
+		gaps.append(gap)
+		cost = gap // 2 + 1
+		if(cost <= first_preferences[next_lowest] and (order_bound is None or cost < order_bound)):
+			order_bound = cost
+	return winner_bound, order_bound, gaps
+
+# Log the margin bounds of one IRV position. See irv_margin_bounds
+def print_irv_margins(rounds, winner, candidate_names):
+	winner_bound, order_bound, gaps = irv_margin_bounds(rounds, winner)
+	print_write("    Margin analysis:")
+	print_write("        Gap above the eliminated candidate in each round: " + str(gaps))
+	if(winner_bound is None):
+		print_write("        Changed ballots needed to alter the winner: could not be bounded")
+	else:
+		print_write("        Changed ballots needed to alter the winner: at most " + str(winner_bound))
+	if(order_bound is None):
+		print_write("        Changed ballots needed to alter the elimination order: could not be bounded")
+	else:
+		print_write("        Changed ballots needed to alter the elimination order: at most " + str(order_bound))
+
+# Winner of an IRV count over a rank matrix and pattern weights, following the same rules
+# as run_off, or None on a tie
+def irv_winner(ranks, weights):
+	in_race = np.ones(ranks.shape[1], dtype=bool)
+	while(True):
+		counts = count_first_preferences(ranks, weights, in_race)
+		remaining = np.flatnonzero(in_race)
+		if(len(remaining) == 1):
+			return remaining[0]
+		if(counts.max() * 2 > counts.sum()):
+			return counts.argmax()
+		fewest = counts[remaining].min()
+		lowest = remaining[counts[remaining] == fewest]
+		if(len(lowest) == len(remaining)):
+			return None
+		in_race[lowest] = False
+
+# Count "num_samples" resampled elections and return how often each candidate won.
+# Resampling draws as many ballots as were cast from the patterns with replacement.
+# Runs in a worker process, so it takes and returns plain picklable values
+def irv_bootstrap_chunk(args):
+	ranks, weights, num_samples, seed = args
+	generator = np.random.RandomState(seed)
+	num_ballots = int(weights.sum())
+	probabilities = weights / float(num_ballots)
+	wins = {}
+	for sample_num in range(num_samples):
+		resampled = generator.multinomial(num_ballots, probabilities)
+		winner = irv_winner(ranks, resampled)
+		wins[winner] = wins.get(winner, 0) + 1
+	return wins
+
+# Log how often "winner" also wins IRV_BOOTSTRAP_SAMPLES resampled elections. The samples
+# are split into chunks of IRV_BOOTSTRAP_CHUNK_SAMPLES, each seeded by its index, and the
+# chunks are shared over IRV_BOOTSTRAP_PROCESSES worker processes, so the estimate is
+# reproducible and does not depend on the number of processes
+def print_irv_stability(ranks, weights, winner, candidate_names):
+	num_processes = IRV_BOOTSTRAP_PROCESSES or multiprocessing.cpu_count()
+	chunks = [(ranks, weights, min(IRV_BOOTSTRAP_CHUNK_SAMPLES, IRV_BOOTSTRAP_SAMPLES - first_sample), n) \
+	for n, first_sample in enumerate(range(0, IRV_BOOTSTRAP_SAMPLES, IRV_BOOTSTRAP_CHUNK_SAMPLES))]
+	if(num_processes == 1):
+		results = map(irv_bootstrap_chunk, chunks)
+	else:
+		pool = multiprocessing.Pool(num_processes)
+		try:
+			results = pool.map(irv_bootstrap_chunk, chunks)
+		finally:
+			pool.close()
+			pool.join()
+	wins = {}
+	for chunk_wins in results:
+		for candidate, num_wins in chunk_wins.items():
+			wins[candidate] = wins.get(candidate, 0) + num_wins
+	print_write("    Stability over " + str(IRV_BOOTSTRAP_SAMPLES) + " resampled elections:")
+	for candidate, num_wins in sorted(wins.items(), key=lambda item: -item[1]):
+		if(candidate is None):
+			label = "Tie"
+		elif(candidate == winner):
+			label = candidate_names[candidate] + " (winner)"
+		else:
+			label = candidate_names[candidate]
+		print_write("        " + label + ": " + str(num_wins) \
+		+ " (" + str(num_wins * 100.0 / IRV_BOOTSTRAP_SAMPLES) + " %)")
+
+# Count one position in a tabulation worker and return the log records it wrote and what
+# it added to "RESULTS_STRING". A fatal error is passed back instead of killing the worker
+def run_tabulation_task(position_num):
+	global election_log
+	global RESULTS_STRING
+	global echo_output
+	global IRV_BOOTSTRAP_PROCESSES
+	election_log = ElectionLog(capture=True)
+	RESULTS_STRING = ''
+	echo_output = False
+	# Workers can't start pools of their own. The resampled elections are chunked the same
+	# way whatever the process count, so counting them in-process doesn't change the output
+	IRV_BOOTSTRAP_PROCESSES = 1
+	try:
+		tabulation_task(position_num)
+	except SystemExit:
+		return election_log.captured, RESULTS_STRING, True
+	return election_log.captured, RESULTS_STRING, False
+
+# Run "task" for every position, on TABULATION_PROCESSES forked workers. The log records of
+# each position are written in position order, so the log and "RESULTS_STRING" come out
+# the same as counting the positions one after another. Windows can't fork, so positions
+# are counted in-process there.
+def tabulate_positions(task, num_positions):
+	global RESULTS_STRING
+	global tabulation_task
+	num_processes = min(TABULATION_PROCESSES or multiprocessing.cpu_count(), num_positions)
+	if(num_processes <= 1 or os.name == "nt"):
+		for i in range(num_positions):
+			task(i)
+		return
+	# Set before the pool forks so that every worker inherits it
+	tabulation_task = task
+	pool = multiprocessing.Pool(num_processes)
+	try:
+		for records, results, failed in pool.imap(run_tabulation_task, range(num_positions)):
+			for level, message in records:
+				print_write(message, level)
+			RESULTS_STRING += results
+			if(failed):
+				sys.exit(-1)
+	finally:
+		pool.close()
+		pool.join()
+		tabulation_task = None
+
+# Parse the distinct ballot patterns of one position into a (patterns x candidates) rank
+# matrix and a matching array of weights. Blank entries become RANK_BLANK.
+def build_rank_matrix(patterns, num_candidates):
+	ranks = np.full((len(patterns), num_candidates), RANK_BLANK, dtype=np.int16)
+	weights = np.zeros(len(patterns), dtype=np.int64)
+	for row_num, (pattern, weight) in enumerate(sorted(patterns.items())):
+		weights[row_num] = weight
+		for j in range(num_candidates):
+			if(pattern[j] != ''):
+				ranks[row_num, j] = int(pattern[j])
+	return ranks, weights
+
+# Count every ballot towards its best-ranked candidate that is still in the race.
+# Ballots with no such candidate are exhausted and not counted.
+def count_first_preferences(ranks, weights, in_race):
+	masked = np.where(in_race, ranks, RANK_BLANK)
+	# argmin picks the leftmost column on equal ranks, same as the original scan
+	top_choices = masked.argmin(axis=1)
+	has_choice = masked[np.arange(len(masked)), top_choices] != RANK_BLANK
+	counts = np.bincount(top_choices[has_choice], weights=weights[has_choice], \
+	minlength=len(in_race))
+	return np.rint(counts).astype(np.int64)
+
+# Keeps the ballot patterns of one position bucketed by their current top remaining
+# preference. Recounting after an elimination only redistributes the buckets of the
+# candidates that left the race, so a whole runoff touches each pattern's ranking once.
+class BallotBuckets(object):
+	def __init__(self, ranks, weights):
+		num_candidates = ranks.shape[1]
+		self.weights = weights
+		self.in_race = np.ones(num_candidates, dtype=bool)
+		self.counts = np.zeros(num_candidates, dtype=np.int64)
+		self.buckets = [[] for j in range(num_candidates)]
+		# Ranked candidates of each pattern, best first. Equal ranks keep column order
+		self.preferences = []
+		# Index into "preferences" of each pattern's current top choice
+		self.next_choice = []
+		for pattern_num in range(len(ranks)):
+			ranked = sorted((ranks[pattern_num, j], j) for j in range(num_candidates) \
+			if ranks[pattern_num, j] != RANK_BLANK)
+			self.preferences.append([j for (rank, j) in ranked])
+			self.next_choice.append(0)
+			if(ranked != []):
+				top_choice = ranked[0][1]
+				self.buckets[top_choice].append(pattern_num)
+				self.counts[top_choice] += weights[pattern_num]
+
+	# Return the first preference counts for the candidates still set in "in_race"
+	def count(self, in_race):
+		eliminated = np.flatnonzero(self.in_race & ~in_race)
+		self.in_race = in_race.copy()
+		for candidate in eliminated:
+			for pattern_num in self.buckets[candidate]:
+				preferences = self.preferences[pattern_num]
+				choice = self.next_choice[pattern_num] + 1
+				while(choice < len(preferences) and not in_race[preferences[choice]]):
+					choice += 1
+				self.next_choice[pattern_num] = choice
+				# Ballots that run out of remaining candidates are exhausted
+				if(choice < len(preferences)):
+					self.buckets[preferences[choice]].append(pattern_num)
+					self.counts[preferences[choice]] += self.weights[pattern_num]
+			self.buckets[candidate] = []
+			self.counts[candidate] = 0
+		return self.counts.copy()
 
 # Perform one iteration/round of instant run off voting. Used in IRV vote tabulation.
-def run_off(count_spread, remaining_candidates, start_index, num_candidates, \
-num_positions, num_responses):
+# "in_race" is a boolean mask over candidates kept in sync with "remaining_candidates",
+# "count_votes" maps that mask to first preference counts and "patterns" holds the
+# compressed ballots being counted.
+def run_off(count_spread, remaining_candidates, in_race, count_votes, patterns):
 	global RESULTS_STRING
 	# Make sure data was read before this function was called
 	if(len(all_data) is 0):
-		print_write('FATAL: Worksheet not populated')
+		print_write('FATAL: Worksheet not populated', "ERROR")
 		sys.exit(-1)
 		
 	# Get the votes from all voters, taking into account elminated candidates and invalid votes
-	for i in range(num_responses):
-		if(i in blacklist):
-			continue
-			
-		relevant_votes = all_data[i + 1][start_index : start_index + num_candidates]
-		final_vote = -1; # index in "relevant_votes" designating the desired candidate
-		eliminated = [] # eliminated candidates or 
-		while (final_vote == -1 and len(eliminated) < len(relevant_votes)):
-			best_rank = LARGE_POSITIVE_INT
-			index_of_best_rank = -1
-			# Eliminate NULL votes
-			for j in range(len(relevant_votes)):
-				if(relevant_votes[j] == ''):
-					eliminated.append(j)
-			# Scan for highest eligble vote
-			for j in range(len(relevant_votes)):
-				if(j not in eliminated):
-					if int(relevant_votes[j]) < best_rank:
-						best_rank = int(relevant_votes[j])
-						index_of_best_rank = j
-			if(index_of_best_rank in remaining_candidates):
-				final_vote = index_of_best_rank
-			else:
-				eliminated.append(index_of_best_rank) 
-		# Record this vote
-		if(final_vote is not -1):
-			count_spread[index_of_best_rank] += 1
-			
+	count_spread[:] = count_votes(in_race).tolist()
+		
 	# Coordesponding minimum number of votes for the candidate[s] to evict
 	min_for_this_round = LARGE_POSITIVE_INT;
 	for i in remaining_candidates:
@@ -900,6 +2028,8 @@ num_positions, num_responses):
 		# Remove all other candidates from "remaining_candidates" array
 		del remaining_candidates[:]
 		remaining_candidates.append(index_of_max)
+		in_race[:] = False
+		in_race[index_of_max] = True
 		return
 		
 	# No strict majority. Begin the elimination process (IRV only).
@@ -917,117 +2047,546 @@ num_positions, num_responses):
 		print_write("    Refer to constitution for tie-breaking procedure.") 
 		print_write("    All votes and their associated frequencies:")
 		encountered_vote_patterns = {}
-		for i in range(num_responses):			
-			relevant_votes = all_data[i + 1][start_index : start_index + num_candidates]
+		for pattern, weight in patterns.items():
 			this_vote_pattern = ''
-			for j in range(num_candidates):
-				if(relevant_votes[j] == ''):
+			for rank in pattern:
+				if(rank == ''):
 					this_vote_pattern+= "X"
 				else:
-					this_vote_pattern+= str(relevant_votes[j])
+					this_vote_pattern+= str(rank)
 			if this_vote_pattern in encountered_vote_patterns:
-				encountered_vote_patterns[this_vote_pattern] += 1
+				encountered_vote_patterns[this_vote_pattern] += weight
 			else:
-				encountered_vote_patterns[this_vote_pattern] = 1
+				encountered_vote_patterns[this_vote_pattern] = weight
 		print_write("    " + str(encountered_vote_patterns))
 		del remaining_candidates[:]
+		in_race[:] = False
 	# There was no tie. Exactly one candidate to eliminate
 	else:	
 		for index in min_indices:
 			remaining_candidates.remove(index)
+			in_race[index] = False
+
+# Seats to fill in each of the "num_positions" positions of an STV vote. One seat per
+# position unless told otherwise, which is the same as IRV
+def stv_seats(num_positions):
+	return SEATS_PER_POSITION if SEATS_PER_POSITION != [] else [1] * num_positions
+
+# Read in results from spreadsheet holding voter data and fill SEATS_PER_POSITION seats
+# of every position by single transferable vote. See STVCount
+def get_results_STV(snapshot=None):
+	global RESULTS_STRING
+	position_names, candidates_split = load_ranked_vote("STV", snapshot)
+	num_positions = len(position_names)
+	seats_per_position = stv_seats(num_positions)
+
+	# Find the winners
+	RESULTS_STRING = "Winners:\n"
+	print_write('\nBegin STV Count\n_____________________________________________')
+	def count_position(i):
+		global RESULTS_STRING
+		print_write(position_names[i])
+		ranks, weights = build_rank_matrix(compressed_ballots[i], len(candidates_split[i]))
+		count = STVCount(ranks, weights, seats_per_position[i], candidates_split[i])
+		winners = count.run()
+		RESULTS_STRING += position_names[i] + ": "
+		if(winners is None):
+			RESULTS_STRING += "Tie. Refer to constitution for tie-breaking procedure.\n"
+		else:
+			RESULTS_STRING += ", ".join(candidates_split[i][j] for j in winners) + '\n'
+		print_write('\n_____________________________________________')
+	tabulate_positions(count_position, num_positions)
 
-# Comapre a list of verified votes with the current set of votes to make sure the current
-# set of votes is a superset of the verified set of votes
-def ensure_no_votes_manipulated():
-	num_averites = len(all_email_addresses)
-	if(num_averites == 0):
-		print_write('FATAL: No email addresses')
+# Single transferable vote count of one position with a Droop quota and Gregory surplus
+# transfers. Every distinct ballot pattern is one entry of compact arrays: its ranks, the
+# number of ballots and the value each of them still carries. "piles[j]" holds the
+# patterns currently counting for candidate j, so a transfer only touches the patterns on
+# the pile being transferred.
+class STVCount(object):
+	def __init__(self, ranks, weights, seats, candidate_names):
+		num_candidates = len(candidate_names)
+		self.ranks = ranks
+		self.weights = weights.astype(np.float64)
+		self.values = np.ones(len(ranks))
+		self.seats = seats
+		self.candidate_names = candidate_names
+		self.hopeful = np.ones(num_candidates, dtype=bool)
+		self.elected = []
+		self.tallies = np.zeros(num_candidates)
+		self.piles = [np.zeros(0, dtype=np.int64) for j in range(num_candidates)]
+		self.move(np.arange(len(ranks)))
+		# Droop quota over the ballots that rank anyone
+		self.quota = int(self.tallies.sum()) // (seats + 1) + 1
+
+	# Send the patterns "pattern_nums" to their best-ranked hopeful candidate at their
+	# current value. Patterns without one are exhausted
+	def move(self, pattern_nums):
+		masked = np.where(self.hopeful, self.ranks[pattern_nums], RANK_BLANK)
+		# argmin picks the leftmost column on equal ranks, same as IRV
+		next_choices = masked.argmin(axis=1)
+		has_choice = masked[np.arange(len(masked)), next_choices] != RANK_BLANK
+		pattern_nums = pattern_nums[has_choice]
+		next_choices = next_choices[has_choice]
+		self.tallies += np.bincount(next_choices, \
+		weights=self.weights[pattern_nums] * self.values[pattern_nums], minlength=len(self.hopeful))
+		for candidate in np.unique(next_choices):
+			self.piles[candidate] = np.concatenate((self.piles[candidate], \
+			pattern_nums[next_choices == candidate]))
+
+	# Hand the pile of "candidate" on, scaled by "factor". Surpluses of elected candidates
+	# use factor surplus / votes, excluded candidates pass on their ballots whole
+	def transfer(self, candidate, factor):
+		pile = self.piles[candidate]
+		self.piles[candidate] = np.zeros(0, dtype=np.int64)
+		self.values[pile] *= factor
+		self.move(pile)
+
+	def print_tallies(self):
+		for j in range(len(self.candidate_names)):
+			if(self.hopeful[j] or j in self.elected):
+				print_write("    " + self.candidate_names[j] + " - " + "%.2f" % self.tallies[j])
+		print_write('')
+
+	# Count until every seat is filled. Returns the elected candidates in order of election,
+	# or None on a tie that has to be broken by hand
+	def run(self):
+		print_write("Quota: " + str(self.quota))
+		# Elected candidates whose surplus is still to be transferred
+		surpluses = []
+		round_num = 1
+		while(len(self.elected) < self.seats):
+			print_write("Round: " + str(round_num))
+			round_num += 1
+			self.print_tallies()
+			reached_quota = [j for j in np.flatnonzero(self.hopeful) if self.tallies[j] >= self.quota]
+			for j in sorted(reached_quota, key=lambda j: -self.tallies[j]):
+				print_write("    Elected: " + self.candidate_names[j])
+				self.hopeful[j] = False
+				self.elected.append(j)
+				surpluses.append(j)
+			num_hopeful = int(self.hopeful.sum())
+			if(len(self.elected) >= self.seats):
+				break
+			if(len(self.elected) + num_hopeful <= self.seats):
+				for j in np.flatnonzero(self.hopeful):
+					print_write("    Elected, remaining seats match remaining candidates: " + self.candidate_names[j])
+					self.hopeful[j] = False
+					self.elected.append(j)
+				break
+			surpluses = [j for j in surpluses if self.tallies[j] > self.quota]
+			if(surpluses != []):
+				# Transfer the largest surplus first
+				surpluses.sort(key=lambda j: self.tallies[j])
+				j = surpluses.pop()
+				surplus = self.tallies[j] - self.quota
+				print_write("    Transfer surplus of " + self.candidate_names[j] + ": " + "%.2f" % surplus)
+				self.transfer(j, surplus / self.tallies[j])
+				self.tallies[j] = self.quota
+				continue
+			# No surplus left to transfer. Exclude the candidate[s] with the fewest votes
+			hopefuls = np.flatnonzero(self.hopeful)
+			fewest = self.tallies[hopefuls].min()
+			lowest = [j for j in hopefuls if self.tallies[j] == fewest]
+			if(len(self.elected) + num_hopeful - len(lowest) < self.seats):
+				print_write("    Draw for lowest vote count between: " \
+				+ ", ".join(self.candidate_names[j] for j in lowest))
+				print_write("    Refer to constitution for tie-breaking procedure.")
+				return None
+			for j in lowest:
+				print_write("    Excluded: " + self.candidate_names[j])
+				self.hopeful[j] = False
+			for j in lowest:
+				self.transfer(j, 1.0)
+				self.tallies[j] = 0
+		for j in self.elected:
+			print_write("    CONGRATULATIONS WINNER: " + self.candidate_names[j])
+		return self.elected
+
+# Read in results from spreadsheet holding voter data and calculate winners of every
+# position by pairwise comparison of the candidates, using CONDORCET_METHOD
+def get_results_condorcet(snapshot=None):
+	global RESULTS_STRING
+	position_names, candidates_split = load_ranked_vote("condorcet", snapshot)
+	num_positions = len(position_names)
+
+	# Find the winners
+	RESULTS_STRING = "Winners:\n"
+	print_write('\nPairwise Comparison (' + CONDORCET_METHOD + ')\n_____________________________________________')
+	def count_position(i):
+		global RESULTS_STRING
+		print_write(position_names[i])
+		ranks, weights = build_rank_matrix(compressed_ballots[i], len(candidates_split[i]))
+		preferences = pairwise_preferences(ranks, weights)
+		if(CONDORCET_METHOD == "ranked pairs"):
+			winners = ranked_pairs_winners(preferences)
+		else:
+			winners = schulze_winners(preferences)[0]
+		matrix_lines = format_pairwise_matrix(preferences, candidates_split[i])
+		for line in matrix_lines:
+			print_write(line)
+		RESULTS_STRING += position_names[i] + ": "
+		if(len(winners) == 1):
+			print_write("    CONGRATULATIONS WINNER: " + candidates_split[i][winners[0]])
+			RESULTS_STRING += candidates_split[i][winners[0]] + '\n'
+		else:
+			print_write("    Draw between: " + ", ".join(candidates_split[i][j] for j in winners))
+			print_write("    Refer to constitution for tie-breaking procedure.")
+			RESULTS_STRING += "Tie. Refer to constitution for tie-breaking procedure.\n"
+		RESULTS_STRING += '\n'.join(matrix_lines) + '\n'
+		print_write('\n_____________________________________________')
+	tabulate_positions(count_position, num_positions)
+
+# Pairwise preference counts of one position from its rank matrix and pattern weights.
+# Entry [i, j] is the number of ballots ranking candidate i above candidate j. A ranked
+# candidate beats an unranked one, equal ranks count for neither.
+def pairwise_preferences(ranks, weights):
+	num_candidates = ranks.shape[1]
+	preferences = np.zeros((num_candidates, num_candidates), dtype=np.int64)
+	for start in range(0, len(ranks), PAIRWISE_CHUNK_SIZE):
+		chunk = ranks[start:start + PAIRWISE_CHUNK_SIZE]
+		prefers = chunk[:, :, np.newaxis] < chunk[:, np.newaxis, :]
+		preferences += np.tensordot(weights[start:start + PAIRWISE_CHUNK_SIZE], prefers, axes=(0, 0))
+	return preferences
+
+# Winners by the Schulze method and the strongest path strengths. A path is as strong as
+# its weakest pairwise win, and a candidate wins if no rival has a stronger path to them
+# than they have to that rival. More than one winner is a tie.
+def schulze_winners(preferences):
+	num_candidates = len(preferences)
+	strengths = np.where(preferences > preferences.T, preferences, 0)
+	# Widest paths through every intermediate candidate in turn, one matrix step each
+	for k in range(num_candidates):
+		strengths = np.maximum(strengths, np.minimum(strengths[:, k:k + 1], strengths[k:k + 1, :]))
+	np.fill_diagonal(strengths, 0)
+	winners = np.flatnonzero((strengths >= strengths.T).all(axis=1))
+	return winners.tolist(), strengths
+
+# Winners by ranked pairs. Pairwise wins are locked in from the largest margin down,
+# skipping any that would close a cycle, and the winners are the candidates nobody is
+# locked in over. Equal margins are taken by more votes for the winner, then in column order.
+def ranked_pairs_winners(preferences):
+	num_candidates = len(preferences)
+	pairs = [(preferences[i, j] - preferences[j, i], preferences[i, j], i, j) \
+	for i in range(num_candidates) for j in range(num_candidates) if preferences[i, j] > preferences[j, i]]
+	pairs.sort(key=lambda pair: (-pair[0], -pair[1], pair[2], pair[3]))
+	locked = np.zeros((num_candidates, num_candidates), dtype=bool)
+	for margin, votes, i, j in pairs:
+		# Skip the pair if j already leads back to i through locked pairs
+		reached = np.zeros(num_candidates, dtype=bool)
+		reached[j] = True
+		frontier = reached.copy()
+		while(frontier.any() and not reached[i]):
+			frontier = locked[frontier].any(axis=0) & ~reached
+			reached |= frontier
+		if(not reached[i]):
+			locked[i, j] = True
+	return np.flatnonzero(~locked.any(axis=0)).tolist()
+
+# Lines of text laying out a pairwise preference matrix, one row per candidate. Column j
+# of row i is how many ballots rank candidate i above candidate #j
+def format_pairwise_matrix(preferences, candidate_names):
+	num_candidates = len(candidate_names)
+	width = max(len(str(preferences.max())), len(str(num_candidates)) + 1) + 2
+	lines = ["    Pairwise preferences (row over column):"]
+	lines.append("    " + " " * 4 + "".join(("#" + str(j + 1)).rjust(width) for j in range(num_candidates)))
+	for i in range(num_candidates):
+		cells = ["-".rjust(width) if i == j else str(preferences[i, j]).rjust(width) \
+		for j in range(num_candidates)]
+		lines.append("    " + ("#" + str(i + 1)).ljust(4) + "".join(cells) + "  " + candidate_names[i])
+	return lines
+
+# Tamper evidence for the rows of voter data. Keeps one fixed-size digest per row, by row
+# position, plus a rolling digest chained over every row so far. The chain confirms a
+# whole prefix in one comparison, the per-row digests say which rows changed.
+class RowFingerprints(object):
+	def __init__(self):
+		self.row_digests = []
+		# prefix_digests[i] covers rows 0 to i
+		self.prefix_digests = []
+
+	def __len__(self):
+		return len(self.row_digests)
+
+	# Digest of one row. Trailing blank cells are Google padding and are ignored
+	@staticmethod
+	def digest_row(row):
+		cells = list(row)
+		while(cells != [] and cells[-1] == ''):
+			cells.pop()
+		encoded = [cell.encode('utf-8') if isinstance(cell, unicode) else str(cell) for cell in cells]
+		return hashlib.sha256('\x1f'.join(encoded)).digest()
+
+	# Digest of the rows up to "row_digest" chained onto the digest of the rows before it
+	@staticmethod
+	def chain(previous_digest, row_digest):
+		return hashlib.sha256(previous_digest + row_digest).digest()
+
+	# Record rows appended after the ones already fingerprinted
+	def append(self, rows):
+		for row in rows:
+			row_digest = self.digest_row(row)
+			previous_digest = self.prefix_digests[-1] if self.prefix_digests != [] else ''
+			self.row_digests.append(row_digest)
+			self.prefix_digests.append(self.chain(previous_digest, row_digest))
+
+	# Check "rows", the current votes from the first one on, against the fingerprints.
+	# Returns the lists of deleted, edited and moved row indices, all empty if nothing
+	# changed. Row order decides which of several votes under one ID counts, so rows that
+	# are still there but no longer in their place (sorted, or pushed down by a row
+	# inserted above them) are moved.
+	def compare(self, rows):
+		num_known = len(self.row_digests)
+		latest_digests = [self.digest_row(row) for row in rows[0:num_known]]
+		if(len(latest_digests) == num_known):
+			rolling_digest = ''
+			for row_digest in latest_digests:
+				rolling_digest = self.chain(rolling_digest, row_digest)
+			if(num_known == 0 or rolling_digest == self.prefix_digests[-1]):
+				return [], [], []
+		# Something changed. Rows whose digest is nowhere in the latest data are gone, and
+		# count as edited when a row that was never seen now sits at their position
+		latest_digests += [self.digest_row(row) for row in rows[num_known:]]
+		latest_set = set(latest_digests)
+		known_set = set(self.row_digests)
+		deleted = []
+		edited = []
+		moved = []
+		for i in range(num_known):
+			if(self.row_digests[i] in latest_set):
+				if(i >= len(latest_digests) or latest_digests[i] != self.row_digests[i]):
+					moved.append(i)
+			elif(i < len(latest_digests) and latest_digests[i] not in known_set):
+				edited.append(i)
+			else:
+				deleted.append(i)
+		return deleted, edited, moved
+
+# Everything the quorum wait needs to know about the votes, derived from the rows each
+# poll fetches: turnout, valid and invalid counts, and the votes themselves so that the
+# snapshot of the final poll can be tabulated without downloading the worksheet again.
+class PollSnapshot(object):
+	def __init__(self):
+		self.header = []
+		self.votes = []
+		self.encountered_IDs = {}
+		self.num_valid = 0
+		self.num_empty = 0
+		self.num_unauthorized = 0
+		self.num_repeated = 0
+		# Running tally of the valid ballots. Created once the header is known
+		self.tally = None
+
+	def num_responses(self):
+		return len(self.votes)
+
+	# Count the votes appended since the last poll. Rows are cut or padded to NUM_COLS
+	def add_votes(self, rows):
+		if(self.tally is None and self.header != []):
+			self.tally = RunningTally(self.header)
+		for row in rows:
+			row = (list(row) + [''] * NUM_COLS)[0:NUM_COLS]
+			self.votes.append(row)
+			reason = classify_voter_id(row[NUM_COLS - 1], self.encountered_IDs)
+			if(reason is None or reason == "REPEATED"):
+				self.tally.add_vote(row)
+			if(reason is None):
+				self.num_valid += 1
+			elif(reason == "EMPTY"):
+				self.num_empty += 1
+			elif(reason == "UNAUTHORIZED"):
+				self.num_unauthorized += 1
+			else:
+				self.num_repeated += 1
+
+	# Copy of the votes laid out like the worksheet, header first
+	def all_data(self):
+		return [list(self.header)] + [list(row) for row in self.votes]
+
+# Valid ballots compressed per position as they arrive, kept equal to what
+# compress_ballots would produce from all votes so far. Each voter ID counts with the
+# latest ballot cast under it, so a re-vote takes the earlier ballot back out.
+class RunningTally(object):
+	def __init__(self, header):
+		first_row = list(header)
+		# Account for padding
+		if('' in first_row):
+			first_row = first_row[0:first_row.index('')]
+		self.vote_type = VOTE_TYPE
+		self.position_names, self.position_candidates, self.position_columns = \
+		parse_positions(first_row, self.vote_type)
+		self.patterns = [{} for position in self.position_columns]
+		# Patterns each voter ID currently counts with
+		self.latest_patterns = {}
+		self.num_replaced = 0
+
+	def patterns_of(self, row):
+		return [tuple(row[start_index : start_index + width]) \
+		for (start_index, width) in self.position_columns]
+
+	# Count a ballot cast under a valid voter ID, replacing any earlier one of that ID
+	def add_vote(self, row):
+		voter_id = row[NUM_COLS - 1]
+		if(voter_id in self.latest_patterns):
+			self.num_replaced += 1
+			for position_num, pattern in enumerate(self.latest_patterns[voter_id]):
+				patterns = self.patterns[position_num]
+				patterns[pattern] -= 1
+				if(patterns[pattern] == 0):
+					del patterns[pattern]
+		new_patterns = self.patterns_of(row)
+		for position_num, pattern in enumerate(new_patterns):
+			patterns = self.patterns[position_num]
+			patterns[pattern] = patterns.get(pattern, 0) + 1
+		self.latest_patterns[voter_id] = new_patterns
+
+	# Copy of the tally in the layout of global variable "compressed_ballots"
+	def ballots(self):
+		return [dict(patterns) for patterns in self.patterns]
+
+	# Per-position counts so far. Answers in a referendum, first preferences in IRV and STV
+	def provisional_counts(self):
+		counts = []
+		for position_num in range(len(self.position_names)):
+			patterns = self.patterns[position_num]
+			candidates = self.position_candidates[position_num]
+			if(self.vote_type == "referendum"):
+				answers = {}
+				for pattern, weight in patterns.items():
+					answers[pattern[0]] = answers.get(pattern[0], 0) + weight
+				counts.append(sorted(answers.items()))
+				continue
+			ranks, weights = build_rank_matrix(patterns, len(candidates))
+			in_race = np.ones(len(candidates), dtype=bool)
+			first_preferences = count_first_preferences(ranks, weights, in_race)
+			counts.append(zip(candidates, first_preferences.tolist()))
+		return counts
+
+	# Write the provisional counts to "file_name". Replaces the file in one step so it
+	# can be read at any time
+	def write(self, file_name):
+		lines = ["Provisional tally as of " + str(datetime.datetime.now()), \
+		"Valid ballots: " + str(len(self.latest_patterns)) \
+		+ ", replaced by a re-vote: " + str(self.num_replaced)]
+		for position_name, counts in zip(self.position_names, self.provisional_counts()):
+			lines.append("")
+			lines.append(position_name)
+			for option, count in counts:
+				lines.append("    " + option + ": " + str(count))
+		temp_file_name = file_name + ".tmp"
+		file = open(temp_file_name, "w")
+		file.write('\n'.join(line.encode('utf-8') if isinstance(line, unicode) else line \
+		for line in lines) + '\n')
+		file.close()
+		replace_file(temp_file_name, file_name)
+
+# Run one poll of the voter data worksheet and return the updated snapshot. Most polls
+# only fetch the rows appended since the last one. The first poll, every
+# INTEGRITY_CHECK_EVERY_N_POLLS-th poll and any poll with "full_check" set download the
+# whole worksheet and make sure no vote seen so far was deleted, edited or moved.
+def poll_votes(full_check=False):
+	global vote_fingerprints
+	global vote_snapshot
+	global num_polls
+	if(roster is None or len(roster) == 0):
+		print_write('FATAL: No email addresses', "ERROR")
 		sys.exit(-1)
 	elif(SUBJECT == ''):
-		print_write('FATAL: No subject line')
+		print_write('FATAL: No subject line', "ERROR")
 		sys.exit(-1)
 	elif(WORKSHEET_TITLE == ''):
-		print_write("FATAL: worksheet title not specified")
-		sys.exit(-1)
-	elif(all_email_addresses == []):
-		print_write("FATAL: no emails specified")
+		print_write("FATAL: worksheet title not specified", "ERROR")
 		sys.exit(-1)
 	elif(NUM_COLS == -1):
-		print_write("FATAL: number of spreadsheet columns not specified")
+		print_write("FATAL: number of spreadsheet columns not specified", "ERROR")
 		sys.exit(-1)
 		
+	if(vote_fingerprints is None):
+		vote_fingerprints = RowFingerprints()
+		vote_snapshot = PollSnapshot()
+	poll_start = time.time()
 	worksheet = renewed_worksheet()
-	num_responses = get_num_responses_on_recently_renewed_worksheet(worksheet)
-	latest_data = grab_all_data_safe(worksheet)
-	latest_votes = {}
-	# Encode vote info into a string
-	for i in range(num_responses):
-		relevant_votes = latest_data[i + 1] # +1 to account for header row
-		encoded_vote = ''
-		for j in range(len(relevant_votes)):
-			encoded_vote += str(relevant_votes[j])
-		latest_votes[encoded_vote] = True
-		
-	# Array of all encoded votes seen so far
-	global votes_seen_so_far
-	num_votes_seen_so_far = len(votes_seen_so_far)
-	# Check that all existing votes exist in the latest batch of pulled votes
-	for i in range(num_votes_seen_so_far):
-		if votes_seen_so_far[i] not in latest_votes:
-			email_tamper_notification()
-	# Add any new votes to existing votes
-	for encoded_vote in latest_votes.keys():
-		if encoded_vote not in votes_seen_so_far:
-			votes_seen_so_far.append(encoded_vote)
+	num_polls += 1
+	if(vote_snapshot.header != [] and not full_check and num_polls % INTEGRITY_CHECK_EVERY_N_POLLS != 0):
+		poll_type = "Delta"
+		# +2 skips the header and converts to 1-indexed spreadsheet rows
+		new_votes = grab_rows_from_safe(worksheet, len(vote_fingerprints) + 2)
+	else:
+		poll_type = "Full"
+		latest_data = grab_all_data_safe(worksheet)
+		# +1 to account for header row
+		latest_votes = latest_data[1:get_num_rows_in(latest_data)]
+		ensure_no_votes_manipulated(latest_votes)
+		vote_snapshot.header = latest_data[0]
+		new_votes = latest_votes[len(vote_fingerprints):]
+	metrics.count("polls_total", poll_type)
+	metrics.count("poll_new_votes_total", poll_type, len(new_votes))
+	vote_fingerprints.append(new_votes)
+	vote_snapshot.add_votes(new_votes)
+	if(PROVISIONAL_TALLY_FILE != ''):
+		vote_snapshot.tally.write(output_path(PROVISIONAL_TALLY_FILE))
+	metrics.observe("poll_seconds", poll_type, time.time() - poll_start)
+	return vote_snapshot
+
+# Compare the fingerprints of the verified votes with the full current set of votes to make
+# sure no vote seen so far was deleted, edited or moved
+def ensure_no_votes_manipulated(latest_votes):
+	global votes_manipulated
+	deleted, edited, moved = vote_fingerprints.compare(latest_votes)
+	if(deleted != [] or edited != [] or moved != []):
+		votes_manipulated = True
+		# +2 converts vote indices to 1-indexed spreadsheet rows below the header
+		print_write("Deleted votes at rows: " + str([i + 2 for i in deleted]), "ERROR")
+		print_write("Edited votes at rows: " + str([i + 2 for i in edited]), "ERROR")
+		print_write("Moved votes from rows: " + str([i + 2 for i in moved]), "ERROR")
+		email_tamper_notification()
 					
-# Vote tamper detected. Email all eligible voters and exit.
+# Vote tamper detected. Email all eligible voters on tamper_notice_job, so that other
+# elections keep polling meanwhile, and exit.
 def email_tamper_notification():
+	global tamper_notice_job
 	sender = HOST_GMAIL_ACCOUNT
-	server = smtplib.SMTP("smtp.gmail.com", 587)
-	server.ehlo()
-	server.starttls()
-	server.login(sender, gmail_password)
 	FROM = sender
 	
-	num_averites = len(all_first_names)
-	for i in range(num_averites):
-		try:
-			TO = all_email_addresses[i]
-			TEXT = "Hi " + all_first_names[i] + ', ' \
+	num_averites = len(roster)
+	# The job runs while other elections are entered, so it only uses what it is given here
+	voters = roster.voters
+	survey_ids = list(all_survey_ids)
+	subject = SUBJECT
+	def tamper_emails():
+		for i in range(num_averites):
+			TO = voters[i].email
+			TEXT = "Hi " + voters[i].first_name + ', ' \
 			+ "\n\nThe vote has been terminated due to detection of vote manipulation\n" \
-			+ "\n\nSurvey ID (should match the first email): " + str(all_survey_ids[i]) \
+			+ "\n\nSurvey ID (should match the first email): " + str(survey_ids[i]) \
 			+ "\nGithub repo: https://github.com/jordanbonilla/OnlineVoting"
 			# Prepare actual message
 			message = """\From: %s\nTo: %s\nSubject: %s\n\n%s
-			""" % (FROM, TO, "*CANCELED* " + SUBJECT, TEXT)
-			server.sendmail(FROM, TO, message)
-		except:
-			email_recovery(server, FROM, TO, message, TO)
-		# Don't risk sending too many emails in too short a time span
-		time.sleep(2)
-	print_write("Vote terminated due to a vote being manipulated")
-	server.quit()
+			""" % (FROM, TO, "*CANCELED* " + subject, TEXT)
+			yield TO, message
+
+	tamper_notice_job = BackgroundJob(lambda: deliver_emails(tamper_emails(), num_averites, gmail_password))
+	print_write("Vote terminated due to a vote being manipulated", "ERROR")
 	sys.exit(-1)
 		
 # Verify survey URL meets specifications
 def verify_survey(survey_url):
 	if(survey_url[-1] != '='):
-		print_write('FATAL: Invalid spreadsheet URL, did you remember to change the URL to pre-fill ID?')
+		print_write('FATAL: Invalid spreadsheet URL, did you remember to change the URL to pre-fill ID?', "ERROR")
 		sys.exit(-1)
 	elif('https://docs.google.com/forms' not in survey_url):
-		print_write("FATAL: Invalid spreadsheet URL. Please check for typos.")
+		print_write("FATAL: Invalid spreadsheet URL. Please check for typos.", "ERROR")
 		sys.exit(-1)
 		
 # Make sure that the worksheet exists on the spreadsheet specified by LINKED_SPREADSHEET_KEY
 def verify_voter_data_worksheet():
 	if(WORKSHEET_TITLE == ''):
-		print_write("FATAL: Global WORKSHEET_TITLE not populated")
+		print_write("FATAL: Global WORKSHEET_TITLE not populated", "ERROR")
 		sys.exit(-1)
 
 	worksheet = renewed_worksheet()
 
 
-	if(VOTE_TYPE is 'IRV'):
+	if(VOTE_TYPE is 'IRV' or VOTE_TYPE is 'STV' or VOTE_TYPE is 'condorcet'):
 		# Read back the election info so it can be confirmed
 		first_row = get_first_row_cleaned(worksheet)
 		encountered_positions = []
@@ -1058,7 +2617,7 @@ def verify_voter_data_worksheet():
 		first_col = grab_col_safe(worksheet, 1)
 		for i in range(1, len(first_col)):	#Skip header info
 			if(first_col[i] != ''):
-				print_write("FATAL: specified worksheet is not blank. Do NOT reuse worksheets")
+				print_write("FATAL: specified worksheet is not blank. Do NOT reuse worksheets", "ERROR")
 				sys.exit(-1)
 
 	elif(VOTE_TYPE is 'referendum'):
@@ -1079,23 +2638,19 @@ def verify_voter_data_worksheet():
 		first_col = grab_col_safe(worksheet, 1)
 		for i in range(1, len(first_col)):	#Skip header info
 			if(first_col[i] != ''):
-				print_write("FATAL: specified worksheet is not blank. Do NOT reuse worksheets")
+				print_write("FATAL: specified worksheet is not blank. Do NOT reuse worksheets", "ERROR")
 				sys.exit(-1)	
 	else:
-		print_write("Invalid vote type")
+		print_write("Invalid vote type", "ERROR")
 		sys.exit(-1)
 			
 # Make sure that the gmail password associated with the host is correct
 def verify_gmail_pass(gmail_password):
 	try:
-		sender = HOST_GMAIL_ACCOUNT
-		server = smtplib.SMTP("smtp.gmail.com", 587)
-		server.ehlo()
-		server.starttls()
-		server.login(sender, gmail_password)
+		server = smtp_connect(gmail_password)
 		server.quit()
 	except:
-		print_write("Wrong gmail password name. Exiting")
+		print_write("Wrong gmail password name. Exiting", "ERROR")
 		sys.exit(-1)
 		
 # Check if this is an IRV vote or referendum so rules can be modified
@@ -1106,7 +2661,7 @@ def verify_vote_type():
 	except ValueError:
 	   print("That's not an int!")
 	   sys.exit(-1)
-	if(VOTE_TYPE != 1 and VOTE_TYPE != 2):
+	if(VOTE_TYPE not in [1, 2, 3, 4]):
 	   print("Invalid vote type: " + str(VOTE_TYPE))
 	   sys.exit(-1)
 	else:
@@ -1114,54 +2669,452 @@ def verify_vote_type():
 			VOTE_TYPE = "referendum"
 		elif(VOTE_TYPE is 2):
 			VOTE_TYPE = "IRV"
+		elif(VOTE_TYPE is 3):
+			VOTE_TYPE = "STV"
+		elif(VOTE_TYPE is 4):
+			VOTE_TYPE = "condorcet"
+	
+# Append-only, encrypted record log of one election. The file starts with CHECKPOINT_MAGIC
+# and the salt the key is derived with. Every record is a marshalled (type, payload) pair
+# sealed with AES-GCM under a fresh nonce and framed by its length. The position of the
+# record is authenticated along with it so records can't be reordered or dropped from the
+# middle. A record torn by a crash mid-write is cut off when the log is reopened.
+class Checkpoint(object):
+	CHECKPOINT_MAGIC = "OVCHK1"
+	SALT_LENGTH = 16
+	NONCE_LENGTH = 12
+
+	def __init__(self, file_name, salt, passphrase):
+		self.file_name = file_name
+		key = hashlib.pbkdf2_hmac('sha256', passphrase, salt, CHECKPOINT_KDF_ITERATIONS, 32)
+		self.cipher = AESGCM(key)
+		self.num_records = 0
+		self.file = None
+
+	# Exit if there is a log at "file_name" already. It belongs to another election
+	@staticmethod
+	def ensure_absent(file_name):
+		if(os.path.exists(file_name)):
+			print_write("FATAL: checkpoint " + file_name + " already exists. Resume it with --resume or remove it", "ERROR")
+			sys.exit(-1)
+
+	# Start a new log. Refuses to overwrite an existing one
+	@classmethod
+	def create(cls, file_name, passphrase):
+		cls.ensure_absent(file_name)
+		salt = os.urandom(cls.SALT_LENGTH)
+		checkpoint = cls(file_name, salt, passphrase)
+		checkpoint.file = open(file_name, "wb")
+		checkpoint.file.write(cls.CHECKPOINT_MAGIC + salt)
+		checkpoint.sync()
+		return checkpoint
+
+	# Open an existing log for appending. Returns the checkpoint and its records in order
+	@classmethod
+	def resume(cls, file_name, passphrase):
+		file = open(file_name, "rb")
+		data = file.read()
+		file.close()
+		header_length = len(cls.CHECKPOINT_MAGIC) + cls.SALT_LENGTH
+		if(data[0:len(cls.CHECKPOINT_MAGIC)] != cls.CHECKPOINT_MAGIC):
+			print_write("FATAL: " + file_name + " is not a checkpoint", "ERROR")
+			sys.exit(-1)
+		checkpoint = cls(file_name, data[len(cls.CHECKPOINT_MAGIC):header_length], passphrase)
+		records = []
+		offset = header_length
+		while(offset + 4 <= len(data)):
+			(frame_length,) = struct.unpack(">I", data[offset:offset + 4])
+			frame = data[offset + 4:offset + 4 + frame_length]
+			if(len(frame) < frame_length):
+				break
+			try:
+				plaintext = checkpoint.cipher.decrypt(frame[0:cls.NONCE_LENGTH], \
+				frame[cls.NONCE_LENGTH:], struct.pack(">Q", len(records)))
+			except InvalidTag:
+				print_write("FATAL: wrong passphrase or corrupted checkpoint " + file_name, "ERROR")
+				sys.exit(-1)
+			records.append(marshal.loads(plaintext))
+			offset += 4 + frame_length
+		checkpoint.num_records = len(records)
+		checkpoint.file = open(file_name, "r+b")
+		# Drop a torn record left by a crash so new records follow the last good one
+		checkpoint.file.truncate(offset)
+		checkpoint.file.seek(offset)
+		return checkpoint, records
+
+	# Append one record and make sure it reached the disk
+	def write(self, record_type, payload):
+		nonce = os.urandom(self.NONCE_LENGTH)
+		sealed = self.cipher.encrypt(nonce, marshal.dumps((record_type, payload)), \
+		struct.pack(">Q", self.num_records))
+		self.file.write(struct.pack(">I", len(nonce) + len(sealed)) + nonce + sealed)
+		self.sync()
+		self.num_records += 1
+
+	def sync(self):
+		self.file.flush()
+		os.fsync(self.file.fileno())
+
+	# Close the log and leave it on disk, to resume the election from
+	def close(self):
+		self.file.close()
+
+	# Close and delete the log once the election is over. It holds the election key
+	def remove(self):
+		self.close()
+		os.remove(self.file_name)
+
+# Module globals that belong to one election. Everything else (the Sheets session, the
+# rate limiters, the mail server settings) is shared by all elections in this process
+ELECTION_STATE = ["survey_url", "VOTE_TYPE", "WORKSHEET_TITLE", "SUBJECT", "QUORUM", \
+"TIME_LIMIT_QUORUM", "OUTPUT_DIR", "NUM_COLS", "ELECTION_KEY", "SEATS_PER_POSITION", \
+"blacklist", "all_data", "roster", \
+"all_survey_ids", "vote_fingerprints", "num_polls", "votes_manipulated", "tamper_notice_job", \
+"vote_snapshot", "election_log", \
+"compressed_ballots", "RESULTS_STRING"]
+ELECTION_DEFAULTS = dict((name, copy.deepcopy(globals()[name])) for name in ELECTION_STATE)
+# Part of the election state saved in a checkpoint once the links are sent. Together with
+# the votes seen so far it is all that is needed to pick up polling again. The voter IDs
+# themselves are not saved, the election key is enough to validate them
+CHECKPOINT_STATE = ["survey_url", "VOTE_TYPE", "WORKSHEET_TITLE", "SUBJECT", "QUORUM", \
+"TIME_LIMIT_QUORUM", "OUTPUT_DIR", "NUM_COLS", "ELECTION_KEY", "SEATS_PER_POSITION", "roster", \
+"all_survey_ids"]
+
+# The state of one election and the steps that carry it from sending the links to
+# emailing the results. The functions above work on the module globals in ELECTION_STATE,
+# so an election is entered with "with election:" to load its state into them and saves
+# it back on the way out. Only one election may be entered at a time.
+class Election(object):
+	def __init__(self, **settings):
+		self.state = copy.deepcopy(ELECTION_DEFAULTS)
+		self.state.update(settings)
+		# End of the current quorum window, None until the first link is sent
+		self.window_end = None
+		self.next_poll_time = time.time()
+		self.finished = False
+		# Background jobs sending the links, sending the results and clearing the sent folder
+		# at the end, None when not running
+		self.links_job = None
+		self.results_job = None
+		self.cleanup_job = None
+		self.first_link_sent = threading.Event()
+		# Set when the election is stopped, so that no more links go out
+		self.links_canceled = threading.Event()
+		# Encrypted log of this election, None if checkpoints are disabled
+		self.checkpoint = None
+		# Whether the next poll has to download the whole worksheet
+		self.full_check_next = False
+
+	# Rebuild an election from its checkpoint without touching the spreadsheet. The first
+	# poll afterwards is a full one, to catch anything that happened while it was down
+	@classmethod
+	def resume(cls, file_name):
+		global vote_fingerprints
+		global vote_snapshot
+		checkpoint, records = Checkpoint.resume(file_name, checkpoint_passphrase)
+		if(records == [] or records[0][0] != "settings"):
+			print_write("FATAL: checkpoint " + file_name + " was written before the links were sent", "ERROR")
+			sys.exit(-1)
+		settings = records[0][1]
+		settings["roster"] = Roster.from_records(settings["roster"])
+		election = cls(**settings)
+		election.checkpoint = checkpoint
+		election.full_check_next = True
+		with election:
+			vote_fingerprints = RowFingerprints()
+			vote_snapshot = PollSnapshot()
+			for record_type, payload in records[1:]:
+				if(record_type == "window"):
+					election.window_end = payload
+				elif(record_type == "header"):
+					vote_snapshot.header = payload
+				elif(record_type == "votes"):
+					vote_fingerprints.append(payload)
+					vote_snapshot.add_votes(payload)
+			# Interrupted between sending the links and opening the first window
+			if(election.window_end is None):
+				election.open_window()
+			print_write("Resumed " + WORKSHEET_TITLE + " from " + file_name + " with " \
+			+ str(vote_snapshot.num_responses()) + " votes")
+		return election
+
+	# Start the checkpoint of this election with the state needed to resume it, along with
+	# the votes polled while the links were going out. It is only started once every link
+	# is out: resuming half-sent links could mail some voters a second valid voter ID, so
+	# an election interrupted before then has to be started again
+	def start_checkpoint(self):
+		if(CHECKPOINT_FILE == '' or checkpoint_passphrase is None):
+			return
+		self.checkpoint = Checkpoint.create(output_path(CHECKPOINT_FILE), checkpoint_passphrase)
+		module_globals = globals()
+		settings = dict((name, module_globals[name]) for name in CHECKPOINT_STATE)
+		settings["roster"] = roster.records()
+		self.checkpoint.write("settings", settings)
+		if(self.window_end is not None):
+			self.checkpoint.write("window", self.window_end)
+		if(vote_snapshot is not None and vote_snapshot.header != []):
+			self.checkpoint.write("header", list(vote_snapshot.header))
+			if(vote_snapshot.votes != []):
+				self.checkpoint.write("votes", vote_snapshot.votes)
+
+	# Poll the votes and append whatever the poll added to the checkpoint
+	def poll(self, full_check=False):
+		num_known = vote_snapshot.num_responses() if vote_snapshot is not None else 0
+		had_header = vote_snapshot is not None and vote_snapshot.header != []
+		snapshot = poll_votes(full_check or self.full_check_next)
+		self.full_check_next = False
+		if(self.checkpoint is not None):
+			if(not had_header):
+				self.checkpoint.write("header", list(snapshot.header))
+			if(snapshot.num_responses() > num_known):
+				self.checkpoint.write("votes", snapshot.votes[num_known:])
+		return snapshot
+
+	def __enter__(self):
+		globals().update(self.state)
+		return self
+
+	def __exit__(self, *exc_info):
+		module_globals = globals()
+		for name in ELECTION_STATE:
+			self.state[name] = module_globals[name]
+			module_globals[name] = copy.deepcopy(ELECTION_DEFAULTS[name])
+		return False
+
+	# Run the next piece of work of this election: starting to send the links, one poll,
+	# closing the quorum window or checking on the results emails or the sent folder
+	# cleanup. The links go out in the background and polling starts as soon as the first
+	# one is sent. The window is not closed before they are all out. The results go out in
+	# the background too, and the checkpoint is only deleted once they are delivered.
+	# Schedules the next step unless the election is over
+	def step(self, gmail_password):
+		if(self.cleanup_job is not None):
+			if(self.cleanup_job.done()):
+				cleanup_job = self.cleanup_job
+				self.cleanup_job = None
+				cleanup_job.result()
+				self.finished = True
+				election_log.close()
+		elif(self.results_job is not None):
+			if(self.results_job.done()):
+				results_job = self.results_job
+				self.results_job = None
+				# Raises the error of a failed delivery
+				results_job.result()
+				if(self.checkpoint is not None):
+					self.checkpoint.remove()
+					self.checkpoint = None
+				# The election is over once the sent folder is cleared
+				self.cleanup_job = BackgroundJob(lambda: delete_sent_folder(HOST_GMAIL_ACCOUNT, gmail_password))
+		elif(self.window_end is None and self.links_job is None):
+			# A leftover checkpoint would only be found once the links are out
+			if(CHECKPOINT_FILE != '' and checkpoint_passphrase is not None):
+				Checkpoint.ensure_absent(output_path(CHECKPOINT_FILE))
+			# Load all eligible voters into global variable "roster"
+			load_roster()
+			# Load the number of columns in the spreadsheet into global variable to minimize API calls
+			get_num_columns()
+			# All input params are good. Email links to the survey 
+			self.links_job = email_the_links(gmail_password, self.first_link_sent, self.links_canceled)
+		else:
+			if(self.links_job is not None and self.links_job.done()):
+				links_job = self.links_job
+				self.links_job = None
+				# Raises the error of a failed delivery
+				links_job.result()
+				self.start_checkpoint()
+			if(self.window_end is None and self.first_link_sent.is_set()):
+				self.open_window()
+			if(self.window_end is not None and time.time() >= self.window_end and self.links_job is None):
+				self.close_window(gmail_password)
+			elif(self.window_end is not None):
+				self.poll()
+		if(self.window_end is None or self.results_job is not None or self.cleanup_job is not None):
+			# Check again shortly for the first link or the end of the job
+			self.next_poll_time = time.time() + 1
+		else:
+			random_time_slice = CHECKS_INTERVAL + random.randint(1, 5) # Add variability for security
+			self.next_poll_time = time.time() + random_time_slice
+
+	# Give up on this election after a fatal error. Links not sent yet are canceled. An
+	# election stopped by tampering is over for good, so its checkpoint is deleted rather
+	# than left behind with the election key in it. After any other error, such as a lost
+	# connection outlasting the retries, the checkpoint is kept to resume the election from
+	def stop(self):
+		self.links_canceled.set()
+		if(self.checkpoint is None):
+			return
+		if(votes_manipulated):
+			self.checkpoint.remove()
+		else:
+			self.checkpoint.close()
+			print_write("Checkpoint kept. Resume the election with: python vote.py --resume " \
+			+ self.checkpoint.file_name, "ERROR")
+		self.checkpoint = None
+
+	# Wait for the background jobs of an election that was stopped, so that its sent
+	# folder is still cleared and its voters hear that the vote was canceled. Fatal errors
+	# were logged by the jobs, anything else is logged here
+	def wait_for_jobs(self):
+		for job in [self.links_job, self.results_job, self.cleanup_job, tamper_notice_job]:
+			if(job is not None):
+				try:
+					job.result()
+				except SystemExit:
+					pass
+				except Exception as e:
+					print_write("FATAL: " + repr(e), "ERROR")
+
+	def open_window(self):
+		print_write('Waiting 24 hours for quorum to be reached...')
+		self.window_end = time.time() + TIME_LIMIT_QUORUM
+		if(self.checkpoint is not None):
+			self.checkpoint.write("window", self.window_end)
+
+	# Check for quorum on a fully verified snapshot. It is also the one that gets tabulated
+	def close_window(self, gmail_password):
+		snapshot = self.poll(full_check=True)
+		print_write("Number of valid votes so far: " + str(snapshot.num_valid) + ", Quorum: " + str(QUORUM))
+		print_write("Invalid votes so far: " + str(snapshot.num_empty) + " empty, " \
+		+ str(snapshot.num_unauthorized) + " unauthorized, " + str(snapshot.num_repeated) + " repeated IDs")
+		if(snapshot.num_valid < QUORUM):
+			self.open_window()
+			return
+		print_write('Quorum Reached!')
+		print_sheets_retry_summary()
+		# Read in results
+		with metrics.timed("tabulation_seconds", VOTE_TYPE), election_log.report():
+			if VOTE_TYPE is "IRV":
+				get_results_IRV(snapshot)
+			elif VOTE_TYPE is "STV":
+				get_results_STV(snapshot)
+			elif VOTE_TYPE is "condorcet":
+				get_results_condorcet(snapshot)
+			elif VOTE_TYPE is "referendum":
+				get_results_referendum(snapshot)
+		# Retries and connection messages of the write-back belong in the log, not the report
+		write_invalid_vote_marks()
+		# Email results
+		self.results_job = email_results(gmail_password)
+
+# Run "elections" in this process until every one of them is over. Each step is the work
+# of whichever election is due next, so the elections take turns on the shared Sheets
+# session, rate limiters and mail server. An election that hits a fatal error, or any
+# other error such as a failed background job, is stopped and the others carry on. Exits with an error once done if any election failed. The
+# metrics are written between steps and once more at the end.
+def run_elections(elections, gmail_password):
+	queue = []
+	num_steps = 0
+	for election in elections:
+		heapq.heappush(queue, (election.next_poll_time, num_steps, election))
+		num_steps += 1
+	num_failed = 0
+	while(queue != []):
+		due, step_num, election = heapq.heappop(queue)
+		write_metrics()
+		wait = max(0, due - time.time())
+		time.sleep(wait)
+		metrics.count("sleep_seconds_total", "Poll interval", wait)
+		with election:
+			try:
+				election.step(gmail_password)
+			except (SystemExit, Exception) as e:
+				if(not isinstance(e, SystemExit)):
+					print_write("FATAL: " + repr(e), "ERROR")
+				print_write("Election stopped: " + WORKSHEET_TITLE, "ERROR")
+				election.stop()
+				num_failed += 1
+				continue
+		if(not election.finished):
+			# Steps taken later go later among elections due at the same time
+			heapq.heappush(queue, (election.next_poll_time, num_steps, election))
+			num_steps += 1
+	for election in elections:
+		with election:
+			election.wait_for_jobs()
+	write_metrics(force=True)
+	if(num_failed != 0):
+		sys.exit(-1)
+
+# Ask how many seats each position of an STV vote fills
+def prompt_seats_per_position():
+	global SEATS_PER_POSITION
+	position_names, position_candidates, position_columns = \
+	parse_positions(get_first_row_cleaned(renewed_worksheet()), VOTE_TYPE)
+	SEATS_PER_POSITION = []
+	for i in range(len(position_names)):
+		seats = raw_input('Number of seats for ' + position_names[i].strip() + ':')
+		try:
+			seats = int(seats)
+		except ValueError:
+			print("That's not an int!")
+			sys.exit(-1)
+		if(seats < 1 or seats > len(position_candidates[i])):
+			print("Invalid number of seats: " + str(seats))
+			sys.exit(-1)
+		SEATS_PER_POSITION.append(seats)
+
+# Ask for the settings of one election and verify them. With "separate_output" its files
+# are written to a directory named after its worksheet
+def prompt_election(separate_output):
+	global survey_url
+	global VOTE_TYPE
+	global WORKSHEET_TITLE
+	global SUBJECT
+	global OUTPUT_DIR
+	election = Election()
+	with election:
+		# URL retrived from manually-created Google survey 
+		survey_url = raw_input('Enter survey URL:')
+		verify_survey(survey_url)
+		# Check if this is an IRV vote or referendum so rules can be modified
+		VOTE_TYPE = raw_input('What type of vote is this ? [1(referendum)/ 2(IRV)/ 3(STV)/ 4(condorcet)]:') 
+		verify_vote_type()
+		# Title of worksheet holding voter data.
+		# This title is established when creating the worksheet via Google form creation.
+		WORKSHEET_TITLE = raw_input('Enter worksheet title:') 
+		verify_voter_data_worksheet() 
+		if(VOTE_TYPE is "STV"):
+			prompt_seats_per_position()
+		# Subject as it will appear in emails
+		SUBJECT = raw_input('Enter email subject:') 
+		if(separate_output):
+			OUTPUT_DIR = WORKSHEET_TITLE.replace(os.sep, '_')
+	return election
 	
-# Entry point
+# Ask for the passphrase new checkpoints are encrypted under
+def prompt_checkpoint_passphrase():
+	passphrase = getpass.getpass('[ECHO DISABLED] Enter checkpoint passphrase:')
+	if(passphrase == '' or passphrase != getpass.getpass('[ECHO DISABLED] Confirm checkpoint passphrase:')):
+		print_write("FATAL: checkpoint passphrases empty or not matching", "ERROR")
+		sys.exit(-1)
+	return passphrase
+
+# Entry point. "vote.py --resume <checkpoint> ..." picks up interrupted elections
 if __name__ == "__main__":
 	verify_internet_access()
-	# URL retrived from manually-created Google survey 
-	survey_url = raw_input('Enter survey URL:')
-	verify_survey(survey_url)
-	# Check if this is an IRV vote or referendum so rules can be modified
-	VOTE_TYPE = raw_input('What type of vote is this ? [1(referendum)/ 2(IRV)]:') 
-	verify_vote_type()
-	# Title of worksheet holding voter data.
-	# This title is established when creating the worksheet via Google form creation.
-	WORKSHEET_TITLE = raw_input('Enter worksheet title:') 
-	verify_voter_data_worksheet() 
+	elections = []
+	if(sys.argv[1:2] == ["--resume"]):
+		checkpoint_passphrase = getpass.getpass('[ECHO DISABLED] Enter checkpoint passphrase:')
+		for file_name in sys.argv[2:]:
+			elections.append(Election.resume(file_name))
+	else:
+		num_elections = raw_input('How many elections to run? [1]:')
+		try:
+			num_elections = int(num_elections) if num_elections != '' else 1
+		except ValueError:
+			print("That's not an int!")
+			sys.exit(-1)
+		for i in range(num_elections):
+			if(num_elections > 1):
+				print "\nElection #" + str(i + 1)
+			elections.append(prompt_election(num_elections > 1))
+		if(CHECKPOINT_FILE != ''):
+			checkpoint_passphrase = prompt_checkpoint_passphrase()
 	# Password known by all members of the ExComm
 	gmail_password = getpass.getpass('[ECHO DISABLED] Enter averyexcomm password:') 
 	verify_gmail_pass(gmail_password)
-	# Subject as it will appear in emails
-	SUBJECT = raw_input('Enter email subject:') 
-
-	# Load all email addresses to be used in this survey into global variable "all_email_addresses"
-	get_all_elgible_email_address()
-	# Load the number of columns in the spreadsheet into global variable to minimize API calls
-	get_num_columns()
-	# All input params are good. Email links to the survey 
-	email_the_links(gmail_password)
 
 	# Time-seed random values
 	random.seed
-	while(1):
-		print_write('Waiting 24 hours for quorum to be reached...')
-		elapsed_seconds = 0.0
-		while(elapsed_seconds < TIME_LIMIT_QUORUM):
-			start_time = time.time()
-			random_time_slice = CHECKS_INTERVAL + random.randint(1, 5) # Add variability for security
-			time.sleep(random_time_slice)
-			ensure_no_votes_manipulated()
-			elapsed_time = time.time() - start_time
-			elapsed_seconds += elapsed_time
-		num_valid_votes = get_num_valid_responses()
-		print_write("Number of valid votes so far: " + str(num_valid_votes) + ", Quorum: " + str(QUORUM))
-		if(num_valid_votes >= QUORUM):
-			print_write('Quorum Reached!')
-			break
-	# Read in results
-	if VOTE_TYPE is "IRV":
-		get_results_IRV()
-	elif VOTE_TYPE is "referendum":
-		get_results_referendum()
-	# Email results
-	email_results(gmail_password)
+	run_elections(elections, gmail_password)